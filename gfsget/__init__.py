@@ -0,0 +1,3 @@
+""" Download GFS forecasts from the NOAA OPeNDAP servers """
+
+__version__ = "0.1.0"
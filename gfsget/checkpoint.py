@@ -0,0 +1,108 @@
+# -*- coding: UTF-8 -*-
+""" Checkpoints of the downloads, so interrupted jobs can be resumed """
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+
+# Next to an output FNAME: the directory with the downloaded fragments, the
+# completion marker and the output while it is being written
+PARTS = ".parts"
+DONE = ".done"
+TMP = ".tmp"
+
+MANIFEST = "job.json"
+
+
+def is_done(fname):
+    """Whether fname was completely written, that is, it has its marker"""
+    return os.path.isfile(fname) and os.path.isfile(fname + DONE)
+
+
+def is_artifact(name):
+    """Whether a file name is a fragment directory, a marker or a temporary
+    output of a checkpoint, and not an output"""
+    return name.endswith((PARTS, DONE, TMP))
+
+
+def atomic_write(fname, write, mode="w"):
+    """Write a file with write(f) to a temporary file, and rename it to fname
+    once it is complete, so fname is never left half written"""
+    tmp = fname + TMP
+    try:
+        with open(tmp, mode) as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        os.remove(tmp)
+        raise
+    os.replace(tmp, fname)
+
+
+class Checkpoint:
+    """Downloaded fragments of a job, kept until its output is published
+
+    Every completed sub-request is saved to FNAME.parts/NAME.pkl, so when an
+    interrupted job is run again only the missing fragments are downloaded.
+    The parameters of the job are saved with the fragments, and the fragments
+    of a job with different parameters (or with resume=False) are discarded.
+    """
+
+    def __init__(self, fname, params, resume=True):
+        self.fname = fname
+        self.path = fname + PARTS
+        # Round trip, so tuples compare equal to the lists read back
+        self.params = json.loads(json.dumps(params, default=str))
+
+        manifest = os.path.join(self.path, MANIFEST)
+        if os.path.isdir(self.path) and not (resume and self._read(manifest)):
+            shutil.rmtree(self.path)
+
+        os.makedirs(self.path, exist_ok=True)
+        atomic_write(manifest, lambda f: json.dump(self.params, f))
+
+        self.resumed = len(
+            [name for name in os.listdir(self.path) if name.endswith(".pkl")]
+        )
+
+    def _read(self, manifest):
+        try:
+            with open(manifest, "r") as f:
+                return json.load(f) == self.params
+        except (OSError, ValueError):
+            return False
+
+    def load(self, name, compute, *args, **kwargs):
+        """Fragment name, from a previous run or computed (and saved) with
+        compute(*args, **kwargs)"""
+        fname = os.path.join(self.path, name + ".pkl")
+        if os.path.isfile(fname):
+            with open(fname, "rb") as f:
+                return pickle.load(f)
+
+        data = compute(*args, **kwargs)
+        atomic_write(
+            fname, lambda f: pickle.dump(data, f, pickle.HIGHEST_PROTOCOL), "wb"
+        )
+        return data
+
+    def save_array(self, name, values):
+        """Save an array as the fragment name, to be read back memory mapped"""
+        fname = os.path.join(self.path, name + ".npy")
+        atomic_write(fname, lambda f: np.save(f, values), "wb")
+
+    def load_array(self, name):
+        """Read only, memory mapped array of the fragment name"""
+        return np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+
+    def publish(self, write, mode="w"):
+        """Write the output with write(f), atomically, mark it as complete and
+        remove the fragments"""
+        if os.path.isfile(self.fname + DONE):
+            os.remove(self.fname + DONE)
+        atomic_write(self.fname, write, mode)
+        atomic_write(self.fname + DONE, lambda f: json.dump(self.params, f))
+        shutil.rmtree(self.path)
@@ -0,0 +1,58 @@
+""" Command line entry point with one subcommand per module
+
+Only the module of the subcommand that is run is imported, so downloading a
+forecast does not pay for the import of the plotting libraries, and the help
+is printed without importing any of them.
+"""
+import importlib
+import sys
+
+from . import __version__
+
+# Subcommand: (module, typer function or app, short help)
+COMMANDS = {
+    "realtime": ("gfsget.realtime", "main", "Download from the real time server"),
+    "hist": ("gfsget.hist", "main", "Download from the historical server"),
+    "plot": ("gfsget.plot", "main", "Plot the wind speed of a downloaded file"),
+    "convert": ("gfsget.convert", "main", "Convert text outputs to Parquet"),
+    "archive": ("gfsget.query", "app", "Index and query the downloaded files"),
+    "serve": ("gfsget.serve", "main", "Serve the extraction of regions over HTTP"),
+}
+
+USAGE = "Usage: gfsget [--version] [--help] COMMAND [ARGS]..."
+
+
+def usage():
+    width = max(len(name) for name in COMMANDS)
+    lines = [USAGE, "", "Download and process GFS forecasts", "", "Commands:"]
+    lines += [
+        f"  {name:<{width}}  {short_help}"
+        for name, (_, _, short_help) in COMMANDS.items()
+    ]
+    lines += ["", "Run 'gfsget COMMAND --help' for the options of each command."]
+    return "\n".join(lines)
+
+
+def main(argv: list = None):
+    args = sys.argv[1:] if argv is None else list(argv)
+
+    if not args or args[0] in ("-h", "--help"):
+        print(usage())
+        return 0
+    if args[0] == "--version":
+        print(f"gfsget {__version__}")
+        return 0
+    if args[0] not in COMMANDS:
+        print(f"{USAGE}\n\nError: no such command '{args[0]}'", file=sys.stderr)
+        return 2
+
+    import typer
+
+    name = args[0]
+    module, attr, _ = COMMANDS[name]
+    command = getattr(importlib.import_module(module), attr)
+    if not isinstance(command, typer.Typer):
+        app = typer.Typer(add_completion=False)
+        app.command(name)(command)
+        command = app
+    return command(args=args[1:], prog_name=f"gfsget {name}")
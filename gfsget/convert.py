@@ -0,0 +1,148 @@
+import gzip
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as csv
+import pyarrow.parquet as pq
+import typer
+
+from .checkpoint import is_artifact
+from .utils import set_logging
+
+# Output of the pydap scripts: {date}_{run}, optionally with a suffix, and
+# .gz if it is packed
+FNAME_RE = re.compile(r"^(?P<date>\d{8})_(?P<run>\d{2})")
+
+PARTITION = "date={date}/run={run}/{name}.parquet"
+
+# Lines of the header: time, var and the lat/lon index names
+NHEADER = 3
+
+
+def read_legacy(fname: str):
+    """Read a file with the two level time/var header and lat/lon rows
+
+    The header is parsed by hand and the rest of the file is read as a plain
+    table of floats with the multithreaded CSV reader of pyarrow, which gives
+    the same values as pd.read_csv for the 3 decimals of the outputs. Empty
+    fields are NaN. Packed outputs (.gz) are decompressed.
+    Returns the (time, var) of each column, the lat and lon of each row, and
+    the (nrows, ncols) values.
+    """
+    opener = gzip.open if str(fname).endswith(".gz") else open
+    with opener(fname, "rt") as f:
+        times = [int(time) for time in f.readline().split()[1:]]
+        names = f.readline().split()[1:]
+        f.readline()
+        # Fields of the first row, where NaN is an empty field
+        ncols = len(f.readline().rstrip("\r\n").split(" "))
+
+    if ncols != len(names) + 2:
+        raise ValueError("Header does not match the number of columns", fname)
+
+    table = csv.read_csv(
+        fname,
+        read_options=csv.ReadOptions(
+            skip_rows=NHEADER, autogenerate_column_names=True, use_threads=True
+        ),
+        parse_options=csv.ParseOptions(delimiter=" "),
+        convert_options=csv.ConvertOptions(
+            column_types={f"f{n}": pa.float64() for n in range(ncols)}
+        ),
+    )
+    values = np.empty((table.num_rows, ncols - 2))
+    for n in range(2, ncols):
+        values[:, n - 2] = table.column(n).to_numpy()
+    lat, lon = (table.column(n).to_numpy() for n in (0, 1))
+    return list(zip(times, names)), lat, lon, values
+
+
+def to_long(columns, lat, lon, values):
+    """Reshape the (lat/lon, time/var) table into one row per lat/lon/time
+    and one column per variable, ordered by lat, lon and time"""
+    times = sorted(set(time for time, _ in columns))
+    names = list(dict.fromkeys(var for _, var in columns))
+
+    position = {column: idx for idx, column in enumerate(columns)}
+    nrows, ntime = len(lat), len(times)
+
+    table = {
+        "lat": np.repeat(lat, ntime),
+        "lon": np.repeat(lon, ntime),
+        "time": np.tile(np.array(times, dtype=np.int16), nrows),
+    }
+    for var in names:
+        idx = [position.get((time, var)) for time in times]
+        if None in idx:
+            # Columns missing for some time step (there should be none) are NaN
+            data = np.full((nrows, ntime), np.nan)
+            for n, column in enumerate(idx):
+                if column is not None:
+                    data[:, n] = values[:, column]
+        else:
+            data = values[:, idx]
+        # Contiguous (nrows, ntime) block, so the column is not copied again
+        table[var] = data.reshape(nrows * ntime)
+    return pa.table(table)
+
+
+def convert_file(fname: Path, output: Path, compression: str, force: bool):
+    match = FNAME_RE.match(fname.name)
+    if match is None:
+        logging.warning(f"{fname}: name is not DATE_RUN, skipping")
+        return 0
+    if is_artifact(fname.name) or not fname.is_file():
+        logging.info(f"{fname}: not a complete output, skipping")
+        return 0
+
+    name = fname.name[:-3] if fname.name.endswith(".gz") else fname.name
+    fout = output / PARTITION.format(name=name, **match.groupdict())
+    if fout.exists() and not force:
+        logging.info(f"{fout} already exists")
+        return 0
+
+    try:
+        table = to_long(*read_legacy(fname))
+    except Exception as err:
+        logging.exception(err)
+        return 0
+
+    fout.parent.mkdir(parents=True, exist_ok=True)
+    tmp = fout.with_name(f"{fout.name}.{os.getpid()}.tmp")
+    pq.write_table(table, tmp, compression=compression)
+    os.replace(tmp, fout)
+
+    logging.info(f"{fname} -> {fout}")
+    return table.num_rows
+
+
+def main(
+    files: List[Path],
+    output: Path = Path("archive"),
+    jobs: int = os.cpu_count(),
+    compression: str = "zstd",
+    force: bool = False,
+    log: str = "info",
+):
+    """Convert the text outputs of the pydap scripts to a Parquet archive
+    partitioned by date and run"""
+
+    set_logging(log)
+
+    convert = partial(convert_file, output=output, compression=compression, force=force)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        nrows = sum(executor.map(convert, files))
+
+    logging.info(f"{nrows} rows written to {output}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
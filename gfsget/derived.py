@@ -0,0 +1,147 @@
+# -*- coding: UTF-8 -*-
+""" Derived meteorological variables computed from the downloaded fields """
+import numpy as np
+import pandas as pd
+
+# Reserved key of the JSON configuration files where the derived outputs are
+# declared, for instance:
+#
+#    "derived": {
+#       "wspd10m":  {"func": "speed", "args": ["ugrd10m0", "vgrd10m0"]},
+#       "wdir10m":  {"func": "direction", "args": ["ugrd10m0", "vgrd10m0"]},
+#       "wspd100m": {"func": "speed", "args": ["ugrd100m0", "vgrd100m0"]},
+#       "shear":    {"func": "shear", "args": ["wspd10m", "wspd100m"],
+#                    "heights": [10, 100]}
+#    }
+#
+# The arguments are names of output columns (variable name plus level index),
+# or previously declared derived outputs.
+DERIVED_KEY = "derived"
+
+
+def wind_speed(u, v):
+    """Wind speed from the u and v components"""
+    return np.hypot(u, v)
+
+
+def wind_direction(u, v):
+    """Direction the wind blows from, in degrees clockwise from north"""
+    return np.mod(np.degrees(np.arctan2(-u, -v)), 360.0)
+
+
+def shear_exponent(speed_low, speed_high, heights):
+    """Power-law shear exponent between two heights above ground
+
+    alpha = log(s_high / s_low) / log(z_high / z_low). Calm cells, where the
+    ratio of speeds is not defined, are set to NaN.
+    """
+    z_low, z_high = heights
+    with np.errstate(divide="ignore", invalid="ignore"):
+        alpha = np.log(speed_high / speed_low) / np.log(z_high / z_low)
+    return np.where(np.isfinite(alpha), alpha, np.nan)
+
+
+FUNCS = {
+    "speed": lambda u, v, **kw: wind_speed(u, v),
+    "direction": lambda u, v, **kw: wind_direction(u, v),
+    "shear": lambda low, high, heights, **kw: shear_exponent(low, high, heights),
+}
+
+
+def split_config(var_conf):
+    """Separate the derived outputs from the variables in a configuration"""
+    var_conf = dict(var_conf)
+    derived_conf = var_conf.pop(DERIVED_KEY, {})
+
+    for name, config in derived_conf.items():
+        if config.get("func") not in FUNCS:
+            raise ValueError("Unknown function for derived variable", name)
+        if config["func"] == "shear" and len(config.get("heights", ())) != 2:
+            raise ValueError("Shear needs two heights", name)
+
+    return var_conf, derived_conf
+
+
+def compute_derived(fields, derived_conf):
+    """Compute the derived outputs from a dict of arrays
+
+    All the arrays in ``fields`` must have the same shape, which is kept in the
+    outputs, so this works both for a single time step (ncoord,) and for all
+    the time steps at once (ntime, ncoord). Outputs are computed in order, so
+    they can use the derived outputs declared before them.
+
+    Returns a dict with only the derived outputs.
+    """
+    available = dict(fields)
+    derived = {}
+    for name, config in derived_conf.items():
+        try:
+            args = [available[arg] for arg in config["args"]]
+        except KeyError as err:
+            raise ValueError("Missing input for derived variable", name, str(err))
+        options = {k: v for k, v in config.items() if k not in ("func", "args")}
+        derived[name] = available[name] = FUNCS[config["func"]](*args, **options)
+    return derived
+
+
+def append_derived(data, var_names, derived_conf, drop_raw=False):
+    """Add the derived outputs to an array with the variables in axis 1
+
+    ``data`` has shape (n, nvar, ...) and ``var_names`` the name of each entry
+    along axis 1. If ``drop_raw`` is set, the raw variables used to compute
+    the derived outputs are removed. Returns the new array and names.
+    """
+    if not derived_conf:
+        return data, list(var_names)
+
+    fields = {name: data[:, idx] for idx, name in enumerate(var_names)}
+    derived = compute_derived(fields, derived_conf)
+
+    drop = used_inputs(derived_conf) if drop_raw else set()
+    keep = [idx for idx, name in enumerate(var_names) if name not in drop]
+
+    data = np.concatenate(
+        (data[:, keep], np.stack(list(derived.values()), axis=1)), axis=1
+    )
+    return data, [var_names[idx] for idx in keep] + list(derived)
+
+
+def add_derived(data, derived_conf, drop_raw=False):
+    """Add the derived variables to a DataFrame
+
+    The columns are either the variables, or a (time, var) MultiIndex with
+    the same variables for every time step.
+    """
+    if not derived_conf:
+        return data
+
+    if data.columns.nlevels == 1:
+        values, columns = append_derived(
+            data.values, list(data.columns), derived_conf, drop_raw
+        )
+        return pd.DataFrame(values, index=data.index, columns=columns)
+
+    times = data.columns.unique(level="time")
+    var_names = list(data.columns.unique(level="var"))
+
+    # (nrows, ntime * nvar) -> (nrows, nvar, ntime)
+    values = data.values.reshape(len(data), len(times), len(var_names))
+    values, var_names = append_derived(
+        values.transpose(0, 2, 1), var_names, derived_conf, drop_raw
+    )
+    columns = pd.MultiIndex.from_product((times, var_names), names=["time", "var"])
+    return pd.DataFrame(
+        values.transpose(0, 2, 1).reshape(len(data), -1),
+        index=data.index,
+        columns=columns,
+    )
+
+
+def used_inputs(derived_conf):
+    """Raw variables consumed by the derived outputs"""
+    return {
+        arg
+        for config in derived_conf.values()
+        for arg in config["args"]
+        if arg not in derived_conf
+    }
@@ -0,0 +1,153 @@
+import datetime as dt
+import logging
+from pathlib import Path
+
+import typer
+import xarray as xr
+
+from .interp import METHODS, interpolate_steps
+from .netcdf import coarsen_dataset, to_netcdf_packed
+from .pack import read_rules
+from .utils import set_logging
+
+GFS_HIST_BASE = "https://www.ncei.noaa.gov/thredds/dodsC/model-gfs-004-files"
+
+
+def gfs_hist_url(date: dt.date, run: int, time: int, base: str = GFS_HIST_BASE):
+    date_str = date.strftime("%Y%m%d")
+    month_str = date.strftime("%Y%m")
+    return f"{base}/{month_str}/{date_str}/gfs_3_{date_str}_{run:02d}00_{time:03d}.grb2"
+
+
+def get_gfs_hist(
+    date: dt.date,
+    varlist: list,
+    run: int = 0,
+    time: int = 0,
+    coarsen: int = 1,
+    coarsen_mode: str = "subsample",
+    pack: dict = None,
+):
+
+    date_str = date.strftime("%Y%m%d")
+    url = gfs_hist_url(date, run, time)
+
+    logging.info(url)
+
+    with xr.open_dataset(url) as ds:
+        dataset = coarsen_dataset(ds[varlist], coarsen, coarsen_mode)
+        to_netcdf_packed(dataset, f"{date_str}_{run:02d}_{time:03d}.nc", pack)
+
+
+def open_step(
+    date: dt.date,
+    varlist: list,
+    run: int,
+    time: int,
+    coarsen: int = 1,
+    coarsen_mode: str = "subsample",
+):
+    """Load one time step without its time coordinates, so that different
+    steps can be combined arithmetically"""
+
+    url = gfs_hist_url(date, run, time)
+
+    logging.info(url)
+
+    with xr.open_dataset(url) as ds:
+        dataset = coarsen_dataset(ds[varlist], coarsen, coarsen_mode).load()
+
+    timedims = [dim for dim in dataset.dims if dim.startswith("time")]
+    dataset = dataset.isel({dim: 0 for dim in timedims}, drop=True)
+    return dataset.drop_vars(
+        [name for name in dataset.coords if name.startswith(("time", "reftime"))]
+    )
+
+
+def get_gfs_hist_interp(
+    date: dt.date,
+    varlist: list,
+    run: int = 0,
+    first: int = 0,
+    last: int = 0,
+    step: int = 1,
+    method: str = "linear",
+    coarsen: int = 1,
+    coarsen_mode: str = "subsample",
+    pack: dict = None,
+):
+    """Download the 3-hourly steps from first to last and write one file every
+    step hours, interpolating between consecutive steps as they arrive"""
+
+    date_str = date.strftime("%Y%m%d")
+    reftime = dt.datetime.combine(date, dt.time(hour=run))
+
+    steps = (
+        (time, open_step(date, varlist, run, time, coarsen, coarsen_mode))
+        for time in range(first, last + 1, 3)
+    )
+    for time, dataset in interpolate_steps(steps, step, method):
+        to_netcdf_packed(
+            dataset.expand_dims(time=[reftime + dt.timedelta(hours=time)]),
+            f"{date_str}_{run:02d}_{time:03d}.nc",
+            pack,
+        )
+
+
+def main(
+    date: dt.datetime = None,
+    time: int = 0,
+    run: int = 0,
+    end_time: int = None,
+    step: int = None,
+    method: str = "linear",
+    coarsen: int = 1,
+    coarsen_mode: str = "subsample",
+    pack: Path = None,
+    log: str = "info",
+):
+    """Download a time step, or with --end-time all the steps up to it. With
+    --step they are interpolated to that resolution in hours (linear or cubic).
+    With --pack CONF the variables are packed with the rules of CONF"""
+
+    set_logging(log)
+
+    date = date.date() if date is not None else dt.date.today() - dt.timedelta(days=30)
+
+    variables = [
+        "u-component_of_wind_height_above_ground",
+        "v-component_of_wind_height_above_ground",
+    ]
+    try:
+        rules = read_rules(pack) if pack else None
+        if method not in METHODS:
+            raise ValueError("Unknown interpolation method", method)
+        if end_time is None:
+            get_gfs_hist(
+                date,
+                variables,
+                time=time,
+                run=run,
+                coarsen=coarsen,
+                coarsen_mode=coarsen_mode,
+                pack=rules,
+            )
+        else:
+            get_gfs_hist_interp(
+                date,
+                variables,
+                run=run,
+                first=time,
+                last=end_time,
+                step=step or 3,
+                method=method,
+                coarsen=coarsen,
+                coarsen_mode=coarsen_mode,
+                pack=rules,
+            )
+    except Exception as err:
+        logging.exception(err)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,74 @@
+# -*- coding: UTF-8 -*-
+""" Streaming temporal interpolation of the downloaded time steps """
+from collections import deque
+
+METHODS = ("linear", "cubic")
+
+
+def _targets(start, end, origin, step):
+    """Times origin + k*step in the interval [start, end)"""
+    first = origin + -(-(start - origin) // step) * step
+    return range(first, end, step)
+
+
+def _linear(a, b, times):
+    (t0, f0), (t1, f1) = a, b
+    for time in times:
+        weight = (time - t0) / (t1 - t0)
+        yield time, f0 + (f1 - f0) * weight
+
+
+def _cubic(p0, p1, p2, p3, times):
+    """Cubic Hermite between p1 and p2, with the tangents computed by
+    centered differences (Catmull-Rom for evenly spaced steps)"""
+    (t0, f0), (t1, f1), (t2, f2), (t3, f3) = p0, p1, p2, p3
+    h = t2 - t1
+    m1 = (f2 - f0) * (h / (t2 - t0))
+    m2 = (f3 - f1) * (h / (t3 - t1))
+    for time in times:
+        x = (time - t1) / h
+        x2, x3 = x * x, x * x * x
+        yield time, (
+            f1 * (2 * x3 - 3 * x2 + 1)
+            + m1 * (x3 - 2 * x2 + x)
+            + f2 * (-2 * x3 + 3 * x2)
+            + m2 * (x3 - x2)
+        )
+
+
+def interpolate_steps(steps, step, method="linear"):
+    """Interpolate a sequence of time steps to a finer temporal resolution
+
+    ``steps`` is an iterable of (time, field) in increasing order of time, where
+    the field is anything that supports arithmetic (NumPy arrays, DataFrames
+    with the same columns, ...). Yields (time, field) every ``step`` hours
+    starting from the first time. Only the last two (linear) or four (cubic)
+    input steps are kept in memory, so the input can be a generator that
+    downloads the steps one by one.
+    """
+    if method not in METHODS:
+        raise ValueError("Unknown interpolation method", method)
+
+    window = deque(maxlen=2 if method == "linear" else 4)
+    origin = None
+
+    for time, field in steps:
+        if origin is None:
+            origin = time
+        window.append((time, field))
+
+        if method == "linear" and len(window) == 2:
+            times = _targets(window[0][0], window[1][0], origin, step)
+            yield from _linear(window[0], window[1], times)
+        elif method == "cubic" and len(window) >= 3:
+            p0 = window[-4] if len(window) == 4 else window[-3]
+            times = _targets(window[-3][0], window[-2][0], origin, step)
+            yield from _cubic(p0, window[-3], window[-2], window[-1], times)
+
+    if method == "cubic" and len(window) >= 2:
+        p0 = window[-3] if len(window) >= 3 else window[-2]
+        times = _targets(window[-2][0], window[-1][0], origin, step)
+        yield from _cubic(p0, window[-2], window[-1], window[-1], times)
+
+    if window and (window[-1][0] - origin) % step == 0:
+        yield window[-1]
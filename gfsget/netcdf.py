@@ -0,0 +1,190 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import netCDF4
+import numpy as np
+import pandas as pd
+import xarray as xr
+from xarray.backends.locks import HDF5_LOCK, NETCDFC_LOCK, combine_locks
+
+from .pack import (
+    max_error,
+    merge_errors,
+    pack_dataset,
+    pack_encoding,
+    quantize,
+    rule_for,
+    summary,
+)
+
+COARSEN_MODES = ("subsample", "block-mean")
+
+# The netCDF-C and HDF5 libraries are not thread safe: the calls made outside
+# xarray take the same locks (in the same order) as its netCDF4 backend
+NETCDF_LOCK = combine_locks([NETCDFC_LOCK, HDF5_LOCK])
+
+
+def coarsen_dataset(ds: xr.Dataset, n: int = 1, mode: str = "subsample"):
+    """Keep one of every n cells in lat and lon
+
+    With "subsample" the dataset is sliced with a stride, which for a remote
+    dataset is sent to the server, so only those cells are downloaded. With
+    "block-mean" the n x n blocks are averaged.
+    """
+    if mode not in COARSEN_MODES:
+        raise ValueError("Unknown coarsening mode", mode)
+    if n == 1:
+        return ds
+    if mode == "subsample":
+        return ds.isel(lat=slice(None, None, n), lon=slice(None, None, n))
+    return ds.coarsen(lat=n, lon=n, boundary="trim").mean(keep_attrs=True)
+
+
+def select_region(ds: xr.Dataset, lat: tuple = None, lon: tuple = None):
+    """Select the cells inside a lat/lon box
+
+    Longitudes are given in [-180, 180]. On the 0-360 grids of the servers a
+    box that crosses the Greenwich meridian is built from its western and
+    eastern parts, and the western longitudes are made negative.
+    """
+    if lat is not None:
+        south, north = sorted(lat)
+        descending = ds["lat"].values[0] > ds["lat"].values[-1]
+        ds = ds.sel(lat=slice(north, south) if descending else slice(south, north))
+
+    if lon is not None:
+        west, east = lon
+        if float(ds["lon"].max()) <= 180 or west >= 0:
+            ds = ds.sel(lon=slice(west, east))
+        elif east < 0:
+            ds = ds.sel(lon=slice(west + 360, east + 360))
+            ds = ds.assign_coords(lon=ds["lon"] - 360)
+        else:
+            part_w = ds.sel(lon=slice(west + 360, None))
+            part_w = part_w.assign_coords(lon=part_w["lon"] - 360)
+            ds = xr.concat(
+                [part_w, ds.sel(lon=slice(None, east))],
+                dim="lon",
+                data_vars="minimal",
+                coords="minimal",
+                compat="override",
+            )
+
+    return ds
+
+
+def to_netcdf_packed(dataset: xr.Dataset, fout: str, pack: dict = None):
+    """Write a dataset to a NetCDF file, packed with the rules of gfsget.pack
+    and compressed if pack is not None, logging the compression achieved"""
+    if pack is None:
+        dataset.to_netcdf(fout)
+        return
+
+    dataset = dataset.load()
+    packed, encoding, errors = pack_dataset(dataset, pack)
+    packed.to_netcdf(fout, encoding=encoding)
+    logging.info(summary(fout, dataset.nbytes, errors))
+
+
+def to_netcdf_chunked(
+    dataset: xr.Dataset,
+    fout: str,
+    time_chunk: int = 24,
+    lat_chunk: int = None,
+    complevel: int = 4,
+    coarsen: int = 1,
+    coarsen_mode: str = "subsample",
+    pack: dict = None,
+):
+    """Write a (remote) dataset to a compressed NetCDF file block by block
+
+    The dataset is read in blocks of time_chunk steps (and lat_chunk
+    latitudes) that are written as soon as they arrive, so memory stays at
+    about two blocks: the next one is downloaded in the background while the
+    current one is written. Coarsening is applied to each block. With pack,
+    the variables with a rule are packed as they are written (the scale and
+    offset are fixed by the rules, they do not depend on the data).
+    """
+    ntime, nlat = dataset.sizes["time"], dataset.sizes["lat"]
+    lat_chunk = nlat if lat_chunk is None else lat_chunk
+    # Blocks have to start at a multiple of the coarsening factor
+    lat_chunk = -(-lat_chunk // coarsen) * coarsen
+
+    blocks = [
+        (slice(t, min(t + time_chunk, ntime)), slice(y, min(y + lat_chunk, nlat)))
+        for t in range(0, ntime, time_chunk)
+        for y in range(0, nlat, lat_chunk)
+    ]
+
+    def fetch(block):
+        time, lat = block
+        chunk = dataset.isel(time=time, lat=lat)
+        return coarsen_dataset(chunk, coarsen, coarsen_mode).load()
+
+    # Empty file with all the coordinates and an unlimited time dimension
+    skeleton = coarsen_dataset(dataset.isel(time=slice(0, 0)), coarsen, coarsen_mode)
+    units = f"hours since {pd.Timestamp(dataset['time'].values[0]).isoformat()}"
+    calendar = "proleptic_gregorian"
+    encoding = {"time": {"units": units, "calendar": calendar, "dtype": "f8"}}
+    for name, var in skeleton.data_vars.items():
+        sizes = {
+            "time": min(time_chunk, ntime),
+            "lat": min(-(-lat_chunk // coarsen), var.sizes.get("lat", 1)),
+        }
+        chunksizes = tuple(sizes.get(dim, size) for dim, size in var.sizes.items())
+        encoding[name] = {
+            "zlib": True,
+            "complevel": complevel,
+            "chunksizes": chunksizes,
+        }
+        if pack is not None and rule_for(name, pack)[1] is not None:
+            skeleton[name].encoding = {}
+            encoding[name].update(pack_encoding(rule_for(name, pack)[1]))
+    skeleton.to_netcdf(fout, unlimited_dims=["time"], encoding=encoding)
+
+    nbytes, errors = 0, {}
+
+    # The next block is read by xarray in the background while this thread
+    # writes, so every netCDF call here holds the lock of the library
+    with NETCDF_LOCK:
+        nc = netCDF4.Dataset(fout, "a")
+    try:
+        with ThreadPoolExecutor(1) as executor:
+            future = executor.submit(fetch, blocks[0])
+            for n, (time, lat) in enumerate(blocks):
+                chunk = future.result()
+                if n + 1 < len(blocks):
+                    future = executor.submit(fetch, blocks[n + 1])
+
+                logging.info(f"{fout}: time {time.start}:{time.stop}, lat {lat.start}")
+
+                # Output indices of the block after coarsening
+                out_time = slice(time.start, time.start + chunk.sizes["time"])
+                first_lat = lat.start // coarsen
+                out_lat = slice(first_lat, first_lat + chunk.sizes["lat"])
+                out = {"time": out_time, "lat": out_lat}
+
+                if lat.start == 0:
+                    times = pd.to_datetime(chunk["time"].values).to_pydatetime()
+                    with NETCDF_LOCK:
+                        nc["time"][out_time] = netCDF4.date2num(times, units, calendar)
+                for name, var in chunk.data_vars.items():
+                    index = tuple(out.get(dim, slice(None)) for dim in var.dims)
+                    values = var.values
+                    var_name, rule = rule_for(name, pack or {})
+                    if rule is not None:
+                        # Packed by the netCDF library with the scale and
+                        # offset of the file, missing values as _FillValue
+                        packed = quantize(values, rule, var_name)
+                        merge_errors(errors, {var_name: max_error(values, packed)})
+                        offset = rule.get("offset", 0.0)
+                        values = np.ma.fix_invalid(packed, fill_value=offset)
+                    with NETCDF_LOCK:
+                        nc[name][index] = values
+                nbytes += chunk.nbytes
+    finally:
+        with NETCDF_LOCK:
+            nc.close()
+
+    if pack is not None:
+        logging.info(summary(fout, nbytes, errors))
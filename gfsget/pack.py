@@ -0,0 +1,207 @@
+# -*- coding: UTF-8 -*-
+""" Lossy packing of the variables before they are compressed """
+import json
+import logging
+import os
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+
+# Reserved key of the JSON configuration files with the precision of the
+# variables in the archived outputs, for instance:
+#
+#    "pack": {
+#       "ugrd10m": {"scale": 0.01},
+#       "tmp2m":   {"scale": 0.01, "offset": 273.15},
+#       "pressfc": {"bits": 12}
+#    }
+#
+# With "scale" (and "offset", 0 by default) the values are stored as 16 bit
+# integers, value = offset + scale * n, so the error is at most scale / 2 and
+# the values have to be within offset +- 32767 * scale. With "bits" only that
+# many bits of the mantissa are kept (relative error at most 2 ** -(bits + 1)),
+# and the zeroed bits are removed by the compression. Rules are given for
+# variables, which apply to all their levels, or for output columns.
+PACK_KEY = "pack"
+
+INT16_MAX = 32767
+INT16_FILL = -32768
+
+# Fast compression, most of the reduction comes from the packing
+COMPLEVEL = 1
+
+# Decimals of the text outputs
+DECIMALS = 3
+
+
+def split_pack(var_conf):
+    """Separate the packing rules from the variables in a configuration"""
+    var_conf = dict(var_conf)
+    rules = var_conf.pop(PACK_KEY, {})
+
+    for name, rule in rules.items():
+        if ("scale" in rule) == ("bits" in rule):
+            raise ValueError("Packing rule needs either scale or bits", name)
+        if "scale" in rule and rule["scale"] <= 0:
+            raise ValueError("Packing scale has to be positive", name)
+        if "bits" in rule and not 1 <= rule["bits"] <= 23:
+            raise ValueError("Packing bits have to be in 1..23", name)
+
+    return var_conf, rules
+
+
+def read_rules(fname):
+    """Packing rules of a JSON configuration file"""
+    with open(fname, "r") as f:
+        return split_pack(json.load(f))[1]
+
+
+def rule_for(name, rules):
+    """Name and packing rule of an output column: its own rule, or the rule of
+    its variable (the name without the level index). (name, None) if none"""
+    if name in rules:
+        return name, rules[name]
+    var = name.rstrip("0123456789")
+    return var, rules.get(var)
+
+
+def bitround(values, bits):
+    """Round float32 values to the nearest with only bits bits of mantissa"""
+    values = np.asarray(values, dtype=np.float32)
+    drop = 23 - bits
+    if drop <= 0:
+        return values
+    ints = values.view(np.uint32)
+    # Round half to even, as the float operations
+    half = np.uint32((1 << (drop - 1)) - 1)
+    ints = ints + half + ((ints >> np.uint32(drop)) & np.uint32(1))
+    rounded = (ints & np.uint32(~((1 << drop) - 1) & 0xFFFFFFFF)).view(np.float32)
+    return np.where(np.isfinite(values), rounded, values)
+
+
+def quantize(values, rule, name=None):
+    """Values as they are read back after packing them with a rule. Values
+    out of the range of the 16 bit integers are clipped, with a warning"""
+    if "bits" in rule:
+        return bitround(values, rule["bits"])
+    scale, offset = rule["scale"], rule.get("offset", 0.0)
+    packed = np.round((np.asarray(values) - offset) / scale)
+    clipped = np.count_nonzero(np.abs(packed) > INT16_MAX)
+    if clipped:
+        logging.warning(
+            f"{name or 'Packing'}: {clipped} values out of "
+            f"{offset} +- {INT16_MAX * scale:g} clipped to the 16 bit range"
+        )
+    packed = np.clip(packed, -INT16_MAX, INT16_MAX)
+    return packed * scale + offset
+
+
+def decimals(rule):
+    """Decimals needed to write exactly the values packed with a rule"""
+    if rule is None or "scale" not in rule:
+        return DECIMALS
+    numbers = (rule["scale"], rule.get("offset", 0.0))
+    exponents = [
+        Decimal(repr(float(x))).normalize().as_tuple().exponent for x in numbers
+    ]
+    return max(0, -min(exponents))
+
+
+def max_error(values, packed):
+    diff = np.abs(np.asarray(packed, dtype=np.float64) - values)
+    return float(np.nanmax(diff)) if np.isfinite(diff).any() else 0.0
+
+
+def merge_errors(errors, new):
+    """Update the maximum error of every variable"""
+    for name, error in new.items():
+        errors[name] = max(errors.get(name, 0.0), error)
+    return errors
+
+
+def pack_frame(data, rules):
+    """Pack the columns of a DataFrame for a text output
+
+    Every column is rounded to the values of its rule, and then to the
+    decimals needed to write them, so the text has no more digits than the
+    precision of the variable. Bit rounded variables, and the ones without a
+    rule, are written with the usual 3 decimals. The DataFrame has to be
+    written without float_format. Returns the packed DataFrame and the
+    maximum error of every variable with a rule.
+    """
+    values = data.to_numpy(dtype=np.float64)
+    packed = np.empty_like(values)
+    errors = {}
+
+    names = data.columns.get_level_values(-1)
+    for name in names.unique():
+        idx = np.flatnonzero(names == name)
+        var, rule = rule_for(name, rules)
+        column = values[:, idx]
+        if rule is not None:
+            column = quantize(column, rule, var)
+        # Bit rounded values are float32, rounded as such they would be
+        # written with all the digits of their float64 conversion
+        packed[:, idx] = np.round(np.asarray(column, np.float64), decimals(rule))
+        if rule is not None:
+            merge_errors(errors, {var: max_error(values[:, idx], packed[:, idx])})
+
+    return pd.DataFrame(packed, index=data.index, columns=data.columns), errors
+
+
+def to_csv_packed(data, f, rules, header=True):
+    """Write a DataFrame packed with the rules to the binary file f, as gzip
+    compressed text (several calls append gzip members, which are read as a
+    single file). Returns the maximum error of every variable with a rule"""
+    data, errors = pack_frame(data, rules)
+    compression = {"method": "gzip", "compresslevel": COMPLEVEL, "mtime": 0}
+    data.to_csv(f, sep=" ", header=header, compression=compression)
+    return errors
+
+
+def pack_encoding(rule):
+    """NetCDF encoding of a variable packed with a rule"""
+    if "bits" in rule:
+        return {"dtype": "float32"}
+    return {
+        "dtype": "int16",
+        "scale_factor": rule["scale"],
+        "add_offset": rule.get("offset", 0.0),
+        "_FillValue": INT16_FILL,
+    }
+
+
+def pack_dataset(dataset, rules):
+    """Pack the variables of an (in memory) xarray Dataset with the rules
+
+    Returns the dataset with the values as they are read back, the encoding to
+    write it compressed, as 16 bit integers or bit rounded floats, and the
+    maximum error of every variable with a rule.
+    """
+    dataset = dataset.copy()
+    encoding, errors = {}, {}
+    for name, var in list(dataset.data_vars.items()):
+        encoding[name] = {"zlib": True, "complevel": COMPLEVEL, "shuffle": True}
+        var_name, rule = rule_for(name, rules)
+        if rule is None:
+            continue
+        packed = quantize(var.values, rule, var_name)
+        merge_errors(errors, {var_name: max_error(var.values, packed)})
+        # The encoding of the server does not apply to the packed values
+        dataset[name] = var.copy(data=packed)
+        dataset[name].encoding = {}
+        encoding[name].update(pack_encoding(rule))
+    return dataset, encoding, errors
+
+
+def summary(fname, nbytes, errors):
+    """Compression ratio of a packed file, with respect to the nbytes of its
+    values in memory, and maximum error of every variable"""
+    size = os.path.getsize(fname)
+    text = "{0}: {1:.1f}x compression ({2} bytes)".format(fname, nbytes / size, size)
+    if errors:
+        text += ", max error " + ", ".join(
+            "{0} {1:.3g}".format(name, error) for name, error in errors.items()
+        )
+    return text
@@ -0,0 +1,195 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple
+
+import cartopy.crs as ccrs
+import matplotlib.pyplot as plt
+import matplotlib.ticker as mticker
+import numpy as np
+import pandas as pd
+import typer
+import xarray as xr
+from cartopy.mpl.gridliner import LATITUDE_FORMATTER, LONGITUDE_FORMATTER
+
+from .utils import set_logging
+
+# Extent and levels of the wind speed plots
+WIND_EXTENT = [-45, -35, 45, 35]
+WIND_LEVELS = np.arange(0, 14.5, 1)
+
+
+def degree2radians(degree):
+    # convert degrees to radians
+    return degree * np.pi / 180
+
+
+def wind_map(lon: np.ndarray, lat: np.ndarray, extent: list = WIND_EXTENT):
+    """Figure with the map, gridlines and colorbar of the wind speed plots
+
+    Everything that does not depend on the wind field is drawn here, so it can
+    be reused for many frames.
+    """
+    # Set the figure size, projection, and extent
+    fig = plt.figure(figsize=(9, 5))
+    ax = plt.axes(projection=ccrs.PlateCarree())
+    ax.set_extent(extent)
+    ax.coastlines(resolution="50m", linewidth=1)
+    # Add gridlines
+    gl = ax.gridlines(
+        crs=ccrs.PlateCarree(),
+        draw_labels=True,
+        linewidth=1,
+        color="black",
+        linestyle="--",
+    )
+    gl.top_labels = False
+    gl.right_labels = False
+    gl.xlines = True
+    # gl.xlocator = mticker.FixedLocator([-65, -60, -50, -40, -30])
+    # gl.ylocator = mticker.FixedLocator([30, 40, 50, 60])
+    gl.xformatter = LONGITUDE_FORMATTER
+    gl.yformatter = LATITUDE_FORMATTER
+    gl.xlabel_style = {"size": 10, "color": "black"}
+    gl.ylabel_style = {"size": 10, "color": "black"}
+
+    # The colorbar only depends on the levels, so it is drawn from an empty
+    # field that is removed afterwards
+    cs = ax.contourf(
+        lon, lat, np.zeros(lon.shape), WIND_LEVELS, transform=ccrs.PlateCarree()
+    )
+    cb = fig.colorbar(
+        cs, ax=ax, orientation="vertical", pad=0.02, aspect=16, shrink=0.8
+    )
+    cb.set_label("m/s", size=14, rotation=0, labelpad=15)
+    cb.ax.tick_params(labelsize=10)
+    cs.remove()
+
+    return fig, ax
+
+
+def plot_wind_speed_dir(wind: xr.Dataset, fout: str, extent: list = WIND_EXTENT):
+    """Plot wind speed and direction
+
+    From: https://disc.gsfc.nasa.gov/information/howto?title=How%20to%20calculate%20and%20plot%20wind%20speed%20using%20MERRA-2%20wind%20component%20data%20using%20Python
+    Another example: https://scitools.org.uk/iris/docs/v2.2/examples/Meteorology/wind_speed.html
+    """
+    lon, lat = np.meshgrid(wind["lon"], wind["lat"])
+    u, v = wind["ugrd10m"].data, wind["vgrd10m"].data
+    wspeed = np.sqrt(u ** 2 + v ** 2) * 1.94384
+
+    # wdir = np.arctan2(v, u)
+
+    fig, ax = wind_map(lon, lat, extent)
+
+    # Plot windspeed
+    ax.contourf(lon, lat, wspeed, WIND_LEVELS, transform=ccrs.PlateCarree())
+    ax.set_title("GFS 10m Wind Speed and Direction", size=16)
+    # Overlay wind vectors
+    # qv = plt.quiver(lon, lat, u, v, scale=420, color="k")
+    fig.savefig(fout, format="png", dpi=120)
+    plt.close(fig)
+
+
+# Map of each worker process of plot_wind_speed_frames
+_frame = {}
+
+
+def _init_frame(lon: np.ndarray, lat: np.ndarray, extent: list):
+    fig, ax = wind_map(lon, lat, extent)
+    _frame.update(fig=fig, ax=ax, lon=lon, lat=lat, contour=None)
+
+
+def _render_frame(args):
+    wspeed, title, fout = args
+    if _frame["contour"] is not None:
+        _frame["contour"].remove()
+    _frame["contour"] = _frame["ax"].contourf(
+        _frame["lon"], _frame["lat"], wspeed, WIND_LEVELS, transform=ccrs.PlateCarree()
+    )
+    _frame["ax"].set_title(title, size=16)
+    _frame["fig"].savefig(fout, format="png", dpi=120)
+    return fout
+
+
+def plot_wind_speed_frames(
+    wind: xr.Dataset,
+    outdir: str,
+    extent: list = WIND_EXTENT,
+    workers: int = None,
+    animation: str = None,
+    duration: int = 200,
+):
+    """Plot the wind speed of every time step of a dataset
+
+    The frames are spread across a pool of processes. Each worker draws the
+    map background once and then only replaces the contours of each frame.
+    Writes a PNG per time step in outdir and, if animation is given, an
+    animated GIF with duration milliseconds per frame. Returns the PNG files.
+    """
+    lon, lat = np.meshgrid(wind["lon"], wind["lat"])
+    u, v = wind["ugrd10m"].values, wind["vgrd10m"].values
+    wspeed = np.sqrt(u ** 2 + v ** 2) * 1.94384
+
+    os.makedirs(outdir, exist_ok=True)
+    frames = [
+        (
+            wspeed[n],
+            f"GFS 10m Wind Speed {pd.Timestamp(time):%Y-%m-%d %H:%M}",
+            os.path.join(outdir, f"wind_{n:03d}.png"),
+        )
+        for n, time in enumerate(wind["time"].values)
+    ]
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_frame, initargs=(lon, lat, extent)
+    ) as executor:
+        fnames = list(executor.map(_render_frame, frames))
+
+    if animation is not None:
+        from PIL import Image
+
+        images = [Image.open(fname) for fname in fnames]
+        images[0].save(
+            animation,
+            save_all=True,
+            append_images=images[1:],
+            duration=duration,
+            loop=0,
+        )
+
+    return fnames
+
+
+def main(
+    fname: str,
+    outdir: str = ".",
+    extent: Tuple[float, float, float, float] = tuple(WIND_EXTENT),
+    workers: int = None,
+    animation: str = None,
+    duration: int = 200,
+    log: str = "info",
+):
+    """Plot the 10m wind speed of a file downloaded with the realtime command,
+    one PNG per time step. With --animation the steps are also joined in a GIF"""
+
+    set_logging(log)
+
+    with xr.open_dataset(fname) as ds:
+        wind = ds[["ugrd10m", "vgrd10m"]].load()
+
+    if "time" in wind.dims:
+        fnames = plot_wind_speed_frames(
+            wind, outdir, list(extent), workers, animation, duration
+        )
+    else:
+        os.makedirs(outdir, exist_ok=True)
+        name = os.path.splitext(os.path.basename(fname))[0]
+        fnames = [os.path.join(outdir, f"{name}.png")]
+        plot_wind_speed_dir(wind, fnames[0], list(extent))
+
+    logging.info(f"{len(fnames)} plots written to {outdir}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,420 @@
+import datetime as dt
+import json
+import logging
+import mmap
+import os
+import re
+from collections import OrderedDict
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import pandas as pd
+import typer
+
+from .checkpoint import is_artifact
+from .utils import set_logging
+
+# Output of the pydap scripts ({date}_{run}) and of the xarray scripts
+# ({date}_{run}.nc, {date}_{run}_{hour}.nc)
+FNAME_RE = re.compile(r"^(?P<date>\d{8})_(?P<run>\d{2})")
+
+INDEX_DIR = ".index"
+INDEX_FILE = "index.json"
+
+# Number of header lines of the text outputs: time, var and lat/lon names
+NHEADER = 3
+
+app = typer.Typer()
+
+
+def scan_text(path: Path):
+    """Index a text output: columns, lat/lon of each row and row offsets"""
+    with open(path, "rb") as f:
+        content = f.read()
+
+    # Offsets of the start of every line, plus the end of the file
+    newlines = np.flatnonzero(np.frombuffer(content, dtype=np.uint8) == ord("\n"))
+    starts = np.concatenate(([0], newlines + 1))
+    if starts[-1] != len(content):
+        starts = np.append(starts, len(content))
+
+    lines = content[: starts[NHEADER]].decode().splitlines()
+    if lines[2].split() != ["lat", "lon"]:
+        raise ValueError("Rows are not indexed by lat/lon", lines[2].split())
+    times = [int(time) for time in lines[0].split()[1:]]
+    names = lines[1].split()[1:]
+
+    offsets = starts[NHEADER:]
+    coords = pd.read_csv(
+        path, sep=" ", header=None, skiprows=NHEADER, usecols=[0, 1]
+    ).to_numpy(dtype=np.float64)
+
+    return {"times": times, "vars": names}, {
+        "offsets": offsets,
+        "lat": coords[:, 0],
+        "lon": coords[:, 1],
+    }
+
+
+def scan_netcdf(path: Path):
+    """Index a NetCDF output from its coordinates, without reading any data"""
+    import xarray as xr
+
+    with xr.open_dataset(path) as ds:
+        times = sorted(
+            set(
+                pd.Timestamp(value).isoformat()
+                for name, coord in ds.coords.items()
+                if name.startswith("time") and np.issubdtype(coord.dtype, np.datetime64)
+                for value in np.atleast_1d(coord.values)
+            )
+        )
+        lat, lon = ds["lat"].values, ds["lon"].values
+        lon = np.where(lon > 180, lon - 360, lon)
+        return {"times": times, "vars": list(ds.data_vars)}, {"lat": lat, "lon": lon}
+
+
+class Archive:
+    """Spatial and temporal index over a directory of downloaded files
+
+    The index keeps, for every file, its run, the valid time of its first and
+    last step, its bounding box and variables. Per-file arrays (lat/lon of the
+    rows and the byte offset of every row in the text outputs) are stored
+    next to it, so a query only opens the files that overlap the requested
+    dates and point, and only reads the lines of the requested cells.
+    """
+
+    def __init__(self, root: Path, max_open: int = 64):
+        self.root = Path(root)
+        self.index_dir = self.root / INDEX_DIR
+        self.files = {}
+        self.max_open = max_open
+        self._arrays = OrderedDict()
+        self._maps = OrderedDict()
+
+        fname = self.index_dir / INDEX_FILE
+        if fname.exists():
+            with open(fname, "r") as f:
+                self.files = json.load(f)
+
+    def update(self):
+        """Index new or modified files and forget the removed ones"""
+        self.index_dir.mkdir(exist_ok=True)
+
+        found = {}
+        for path in sorted(self.root.rglob("*")):
+            match = FNAME_RE.match(path.name)
+            if match is None or not path.is_file() or INDEX_DIR in path.parts:
+                continue
+            # Downloads in progress: markers, fragments and temporary outputs
+            if any(map(is_artifact, path.relative_to(self.root).parts)):
+                continue
+            key = str(path.relative_to(self.root))
+            stat = path.stat()
+            entry = self.files.get(key)
+            if (
+                entry
+                and entry["mtime"] == stat.st_mtime
+                and entry["size"] == stat.st_size
+            ):
+                found[key] = entry
+                continue
+            try:
+                found[key] = self._scan(key, path, match, stat)
+            except Exception as err:
+                logging.warning(f"{path}: {err}")
+
+        for key in set(self.files) - set(found):
+            self._arrays_path(key).unlink(missing_ok=True)
+        self.files = found
+
+        tmp = self.index_dir / f"{INDEX_FILE}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.files, f)
+        os.replace(tmp, self.index_dir / INDEX_FILE)
+
+        self._arrays.clear()
+        self._close_maps()
+
+    def _scan(self, key, path, match, stat):
+        logging.info(f"Indexing {path}")
+
+        if path.suffix == ".gz":
+            raise ValueError("Packed text outputs are not indexed, see gfsget convert")
+        if path.suffix == ".nc":
+            entry, arrays = scan_netcdf(path)
+            entry["format"] = "netcdf"
+            start, end = entry["times"][0], entry["times"][-1]
+        else:
+            entry, arrays = scan_text(path)
+            entry["format"] = "text"
+            run = dt.datetime.strptime(match["date"] + match["run"], "%Y%m%d%H")
+            entry["run"] = run.isoformat()
+            start = (run + dt.timedelta(hours=min(entry["times"]))).isoformat()
+            end = (run + dt.timedelta(hours=max(entry["times"]))).isoformat()
+
+        lat, lon = arrays["lat"], arrays["lon"]
+        entry.update(
+            start=start,
+            end=end,
+            bbox=[lat.min(), lat.max(), lon.min(), lon.max()],
+            tol=max(grid_spacing(lat), grid_spacing(lon)) / 2,
+            mtime=stat.st_mtime,
+            size=stat.st_size,
+        )
+        entry["bbox"] = [float(value) for value in entry["bbox"]]
+        np.savez(self._arrays_path(key), **arrays)
+        return entry
+
+    def _arrays_path(self, key):
+        return self.index_dir / (key.replace(os.sep, "__") + ".npz")
+
+    def _load_arrays(self, key):
+        if key not in self._arrays:
+            with np.load(self._arrays_path(key)) as npz:
+                self._arrays[key] = {name: npz[name] for name in npz.files}
+            if len(self._arrays) > self.max_open:
+                self._arrays.popitem(last=False)
+        self._arrays.move_to_end(key)
+        return self._arrays[key]
+
+    def _map(self, key):
+        """Memory-mapped text file, keeping at most max_open of them"""
+        if key not in self._maps:
+            with open(self.root / key, "rb") as f:
+                self._maps[key] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if len(self._maps) > self.max_open:
+                self._maps.popitem(last=False)[1].close()
+        self._maps.move_to_end(key)
+        return self._maps[key]
+
+    def _close_maps(self):
+        while self._maps:
+            self._maps.popitem()[1].close()
+
+    def close(self):
+        self._close_maps()
+
+    def candidates(self, lat, lon, start=None, end=None):
+        """Files overlapping the point and the time range"""
+        for key, entry in self.files.items():
+            if start is not None and entry["end"] < start.isoformat():
+                continue
+            if end is not None and entry["start"] > end.isoformat():
+                continue
+            lat0, lat1, lon0, lon1 = entry["bbox"]
+            tol = entry["tol"]
+            if lat0 - tol <= lat <= lat1 + tol and lon0 - tol <= lon <= lon1 + tol:
+                yield key, entry
+
+    def series(self, points, start=None, end=None, variables=None):
+        """Time series of a list of (lat, lon) points between two datetimes
+
+        Returns a DataFrame with one row per point and valid time, with the
+        lat/lon of the nearest grid cell, and one column per variable. The
+        points are grouped by file, so every file is opened once and all its
+        points are read together.
+        """
+        by_file = OrderedDict()
+        for npoint, (lat, lon) in enumerate(points):
+            for key, _ in self.candidates(lat, lon, start, end):
+                by_file.setdefault(key, []).append(npoint)
+
+        frames = []
+        for key, npoints in by_file.items():
+            entry = self.files[key]
+            npoints = np.array(npoints)
+            lat = np.array([points[npoint][0] for npoint in npoints], dtype=np.float64)
+            lon = np.array([points[npoint][1] for npoint in npoints], dtype=np.float64)
+            try:
+                if entry["format"] == "text":
+                    frame = self._read_text(key, entry, lat, lon, variables)
+                else:
+                    frame = self._read_netcdf(key, entry, lat, lon, variables)
+            except Exception as err:
+                logging.warning(f"{self.root / key}: {err}")
+                continue
+            if frame is None:
+                continue
+            if start is not None:
+                frame = frame[frame["time"] >= start]
+            if end is not None:
+                frame = frame[frame["time"] <= end]
+            # From the position in this file's points to the requested point
+            frame = frame.assign(point=npoints[frame["point"].to_numpy()])
+            frame["file"] = key
+            frames.append(frame)
+
+        if not frames:
+            return pd.DataFrame(columns=["point", "time", "lat", "lon"])
+
+        # For the same valid time, the values of later files (newer runs) are
+        # kept, and variables only present in some of the files are merged
+        data = pd.concat(frames, ignore_index=True)
+        data = data.sort_values(["point", "time", "file"]).drop(columns="file")
+        return data.groupby(["point", "time"], sort=False).last().reset_index()
+
+    def _nearest(self, arrays, entry, lat, lon):
+        """Nearest row of every point, -1 if it is farther than the tolerance
+
+        Only the rows of the latitude band of each point are compared, found
+        by bisection on the rows sorted by latitude.
+        """
+        if "order" not in arrays:
+            arrays["order"] = np.argsort(arrays["lat"], kind="stable")
+            arrays["sorted_lat"] = arrays["lat"][arrays["order"]]
+        order, tol = arrays["order"], entry["tol"]
+        # The band is widened so rounding never leaves out a row within tol
+        first = np.searchsorted(arrays["sorted_lat"], lat - 2 * tol, side="left")
+        last = np.searchsorted(arrays["sorted_lat"], lat + 2 * tol, side="right")
+
+        rows = np.full(len(lat), -1)
+        for idx in range(len(lat)):
+            band = np.sort(order[first[idx] : last[idx]])
+            if not len(band):
+                continue
+            dist = np.maximum(
+                np.abs(arrays["lat"][band] - lat[idx]),
+                np.abs(arrays["lon"][band] - lon[idx]),
+            )
+            best = int(np.argmin(dist))
+            if dist[best] <= tol:
+                rows[idx] = band[best]
+        return rows
+
+    def _read_text(self, key, entry, lat, lon, variables):
+        arrays = self._load_arrays(key)
+        rows = self._nearest(arrays, entry, lat, lon)
+        found = np.flatnonzero(rows >= 0)
+        if not len(found):
+            return None
+        unique, inverse = np.unique(rows[found], return_inverse=True)
+
+        # Every needed line is sliced from the same memory map
+        content, offsets = self._map(key), arrays["offsets"]
+        values = np.array(
+            [
+                # Fields are separated by a single space, and NaN is an empty
+                # field
+                [
+                    field or b"nan"
+                    for field in content[offsets[row] : offsets[row + 1]]
+                    .rstrip(b"\r\n")
+                    .split(b" ")[2:]
+                ]
+                for row in unique
+            ],
+            dtype=np.float64,
+        )
+
+        names = entry["vars"]
+        columns = [
+            idx
+            for idx, name in enumerate(names)
+            if variables is None or name in variables
+        ]
+        frame = (
+            pd.DataFrame(
+                {
+                    "point": np.repeat(found, len(columns)),
+                    "time": np.tile([entry["times"][idx] for idx in columns], len(found)),
+                    "var": np.tile([names[idx] for idx in columns], len(found)),
+                    "value": values[inverse][:, columns].ravel(),
+                }
+            )
+            .pivot(index=["point", "time"], columns="var", values="value")
+            .reset_index()
+        )
+        frame.columns.name = None
+
+        run = dt.datetime.fromisoformat(entry["run"])
+        frame["time"] = run + pd.to_timedelta(frame["time"], unit="h")
+        row = rows[frame["point"].to_numpy()]
+        frame.insert(2, "lat", arrays["lat"][row])
+        frame.insert(3, "lon", arrays["lon"][row])
+        return frame
+
+    def _read_netcdf(self, key, entry, lat, lon, variables):
+        import xarray as xr
+
+        arrays = self._load_arrays(key)
+        ilat = np.argmin(np.abs(arrays["lat"][None, :] - lat[:, None]), axis=1)
+        ilon = np.argmin(np.abs(arrays["lon"][None, :] - lon[:, None]), axis=1)
+
+        names = [
+            name for name in entry["vars"] if variables is None or name in variables
+        ]
+        with xr.open_dataset(self.root / key) as ds:
+            # Only the values of these cells are read from disk, all the
+            # points at once
+            point = (
+                ds[names]
+                .isel(
+                    lat=xr.DataArray(ilat, dims="point"),
+                    lon=xr.DataArray(ilon, dims="point"),
+                )
+                .load()
+            )
+
+        timecol = next((name for name in point.coords if name.startswith("time")), None)
+        if timecol is None:
+            return None
+        # Single hour outputs have time as a scalar coordinate
+        if point[timecol].ndim == 0:
+            point = point.expand_dims(timecol)
+
+        frame = point.drop_vars(["lat", "lon"]).to_dataframe().reset_index()
+        frame = frame.rename(columns={timecol: "time"})
+        frame["lat"] = arrays["lat"][ilat[frame["point"].to_numpy()]]
+        frame["lon"] = arrays["lon"][ilon[frame["point"].to_numpy()]]
+        return frame[["point", "time", "lat", "lon"] + names]
+
+
+def grid_spacing(values):
+    steps = np.diff(np.unique(values))
+    return float(steps.min()) if len(steps) else 0.0
+
+
+@app.command()
+def index(archive: Path, log: str = "info"):
+    """Build or update the index of an archive directory"""
+
+    set_logging(log)
+
+    Archive(archive).update()
+
+
+@app.command()
+def query(
+    archive: Path,
+    lat: List[float] = typer.Option(...),
+    lon: List[float] = typer.Option(...),
+    start: dt.datetime = None,
+    end: dt.datetime = None,
+    var: List[str] = typer.Option(None),
+    output: Path = None,
+    log: str = "info",
+):
+    """Time series of one or several points (repeat --lat and --lon)"""
+
+    set_logging(log)
+
+    if len(lat) != len(lon):
+        raise typer.BadParameter("--lat and --lon must be given the same times")
+
+    store = Archive(archive)
+    if not store.files:
+        store.update()
+
+    data = store.series(list(zip(lat, lon)), start, end, var or None)
+    store.close()
+
+    if output is None:
+        print(data.to_string(index=False))
+    else:
+        data.to_csv(output, index=False)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,118 @@
+import datetime as dt
+import warnings
+import logging
+from pathlib import Path
+
+import typer
+import xarray as xr
+
+from .netcdf import coarsen_dataset, to_netcdf_chunked, to_netcdf_packed
+from .pack import read_rules
+from .utils import set_logging
+
+GFS_BASE = "https://nomads.ncep.noaa.gov/dods"
+
+
+def gfs_url(date: dt.date, run: int, res: str, step: str, base: str = GFS_BASE):
+    date_str = date.strftime("%Y%m%d")
+    return f"{base}/gfs_{res}_{step}/gfs{date_str}/gfs_{res}_{step}_{run:02d}z"
+
+
+def get_gfs(
+    date: dt.date,
+    varlist: list,
+    run: int = 0,
+    hour: int = None,
+    res: str = "0p25",
+    step: str = "1hr",
+    coarsen: int = 1,
+    coarsen_mode: str = "subsample",
+    time_chunk: int = None,
+    lat_chunk: int = None,
+    pack: dict = None,
+):
+    """Download a forecast hour, or the whole forecast if hour is None
+
+    The whole forecast can be many gigabytes, so with time_chunk it is read
+    and written to the file in blocks of time_chunk steps (and lat_chunk
+    latitudes) instead of loading it at once. pack has the packing rules of
+    the variables (see gfsget.pack).
+    """
+
+    date_str = date.strftime("%Y%m%d")
+    url = gfs_url(date, run, res, step)
+
+    logging.info(url)
+
+    with warnings.catch_warnings():
+        # xarray/coding/times.py:119: SerializationWarning: Ambiguous reference date string
+        warnings.filterwarnings(
+            "ignore",
+            category=xr.SerializationWarning,
+            module=r"xarray",
+        )
+        with xr.open_dataset(url) as ds:
+            # We use "nearest" in case of small precision problems
+            if hour is None:
+                dataset = ds[varlist]
+                fout = f"{date_str}_{run:02}.nc"
+                if time_chunk:
+                    to_netcdf_chunked(
+                        dataset,
+                        fout,
+                        time_chunk=time_chunk,
+                        lat_chunk=lat_chunk,
+                        coarsen=coarsen,
+                        coarsen_mode=coarsen_mode,
+                        pack=pack,
+                    )
+                    return
+            else:
+                time = dt.time(hour=hour)
+                dataset = ds[varlist].sel(
+                    time=dt.datetime.combine(date, time), method="nearest"
+                )
+                fout = f"{date_str}_{run:02}_{hour:02}.nc"
+            dataset = coarsen_dataset(dataset, coarsen, coarsen_mode)
+            to_netcdf_packed(dataset, fout, pack)
+
+
+def main(
+    date: dt.datetime = None,
+    hour: int = 0,
+    run: int = 0,
+    full: bool = False,
+    time_chunk: int = None,
+    lat_chunk: int = None,
+    coarsen: int = 1,
+    coarsen_mode: str = "subsample",
+    pack: Path = None,
+    log: str = "info",
+):
+    """Download a forecast hour, or with --full all of them. With --time-chunk
+    the full forecast is streamed to the file in blocks of that many steps.
+    With --pack CONF the variables are packed with the rules of CONF"""
+
+    set_logging(log)
+
+    date = date.date() if date is not None else dt.date.today()
+
+    variables = ["ugrd10m", "vgrd10m"]
+    try:
+        get_gfs(
+            date,
+            variables,
+            hour=None if full else hour,
+            run=run,
+            coarsen=coarsen,
+            coarsen_mode=coarsen_mode,
+            time_chunk=time_chunk,
+            lat_chunk=lat_chunk,
+            pack=read_rules(pack) if pack else None,
+        )
+    except Exception as err:
+        logging.exception(err)
+
+
+if __name__ == "__main__":
+    typer.run(main)
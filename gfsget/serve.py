@@ -0,0 +1,303 @@
+import datetime as dt
+import json
+import logging
+import os
+import tempfile
+import threading
+import warnings
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import typer
+import xarray as xr
+
+from .hist import GFS_HIST_BASE, gfs_hist_url
+from .netcdf import COARSEN_MODES, coarsen_dataset, select_region
+from .realtime import GFS_BASE, gfs_url
+from .utils import set_logging
+
+FORMATS = ("netcdf", "csv")
+
+CONTENT_TYPES = {
+    "netcdf": "application/x-netcdf",
+    "csv": "text/csv",
+    "json": "application/json",
+}
+
+
+def parse_request(kind: str, query: dict):
+    """Normalized key of an extraction request from the query parameters
+
+    Identical requests give the same key, whatever the order or the format of
+    the parameters, so they share the cached or in-flight result.
+    """
+
+    def get(name, default=None):
+        values = query.get(name)
+        return values[-1] if values else default
+
+    def numbers(name, convert=float):
+        value = get(name)
+        if value is None:
+            return None
+        values = tuple(convert(item) for item in value.split(","))
+        if len(values) != 2:
+            raise ValueError(f"{name} needs two values")
+        return values
+
+    if get("date") is None or get("vars") is None:
+        raise ValueError("date and vars are required")
+
+    date = dt.datetime.strptime(get("date").replace("-", ""), "%Y%m%d").date()
+    varlist = tuple(sorted(set(get("vars").split(","))))
+    coarsen = int(get("coarsen", 1))
+    coarsen_mode = get("coarsen_mode", "subsample")
+    fmt = get("format", "netcdf")
+    if coarsen_mode not in COARSEN_MODES or coarsen < 1:
+        raise ValueError("Wrong coarsening", coarsen, coarsen_mode)
+    if fmt not in FORMATS:
+        raise ValueError("Unknown format", fmt)
+
+    common = (varlist, numbers("lat"), numbers("lon"), coarsen, coarsen_mode, fmt)
+    run = int(get("run", 0))
+    if kind == "realtime":
+        hour = get("hour")
+        return (
+            kind,
+            date,
+            run,
+            get("res", "0p25"),
+            get("step", "1hr"),
+            None if hour is None else int(hour),
+            numbers("hours", int),
+        ) + common
+    return (kind, date, run, int(get("time", 0))) + common
+
+
+class Extractor:
+    """Extraction of regions of the forecasts shared between requests
+
+    Identical requests that arrive while the first one is being extracted wait
+    for its result instead of downloading it again. Results are kept in a
+    cache of at most max_bytes, and the remote datasets stay open (with their
+    metadata and coordinates) for the next requests of the same run.
+    """
+
+    def __init__(
+        self,
+        base_url: str = GFS_BASE,
+        hist_base_url: str = GFS_HIST_BASE,
+        max_bytes: int = 256 * 2**20,
+        max_open: int = 16,
+    ):
+        self.base_url = base_url
+        self.hist_base_url = hist_base_url
+        self.max_bytes = max_bytes
+        self.max_open = max_open
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+        self._nbytes = 0
+        self._pending = {}
+        self._datasets = OrderedDict()
+
+    def get(self, key):
+        """Result of a request, from the cache, from the identical request in
+        flight or extracting it"""
+        with self._lock:
+            self.stats["requests"] += 1
+            if key in self._results:
+                self.stats["hits"] += 1
+                self._results.move_to_end(key)
+                return self._results[key]
+            future = self._pending.get(key)
+            owner = future is None
+            if owner:
+                self.stats["misses"] += 1
+                future = self._pending[key] = Future()
+            else:
+                self.stats["coalesced"] += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            result = self.extract(key)
+        except Exception as err:
+            with self._lock:
+                self.stats["errors"] += 1
+                del self._pending[key]
+            future.set_exception(err)
+            raise
+
+        with self._lock:
+            del self._pending[key]
+            self._store(key, result)
+        future.set_result(result)
+        return result
+
+    def _store(self, key, result):
+        if len(result) > self.max_bytes:
+            return
+        self._results[key] = result
+        self._nbytes += len(result)
+        while self._nbytes > self.max_bytes:
+            self._nbytes -= len(self._results.popitem(last=False)[1])
+
+    def dataset(self, url):
+        """Remote dataset, opened once and shared by all the requests"""
+        with self._lock:
+            future = self._datasets.get(url)
+            owner = future is None
+            if owner:
+                future = self._datasets[url] = Future()
+                if len(self._datasets) > self.max_open:
+                    evicted = self._datasets.popitem(last=False)[1]
+                    # Datasets still being opened are left to their owner
+                    if evicted.done() and evicted.exception() is None:
+                        evicted.result().close()
+            self._datasets.move_to_end(url)
+
+        if owner:
+            logging.info(f"Opening {url}")
+            try:
+                with warnings.catch_warnings():
+                    warnings.filterwarnings(
+                        "ignore", category=xr.SerializationWarning, module=r"xarray"
+                    )
+                    future.set_result(xr.open_dataset(url, cache=False))
+            except Exception as err:
+                with self._lock:
+                    if self._datasets.get(url) is future:
+                        del self._datasets[url]
+                future.set_exception(err)
+        return future.result()
+
+    def extract(self, key):
+        kind, date, run = key[:3]
+        varlist, lat, lon, coarsen, coarsen_mode, fmt = key[-6:]
+
+        if kind == "realtime":
+            res, step, hour, hours = key[3:7]
+            ds = self.dataset(gfs_url(date, run, res, step, self.base_url))
+            dataset = ds[list(varlist)]
+            reftime = dt.datetime.combine(date, dt.time(hour=run))
+            if hour is not None:
+                time = reftime + dt.timedelta(hours=hour)
+                dataset = dataset.sel(time=[time], method="nearest")
+            elif hours is not None:
+                # Also "nearest", since the times have small precision problems
+                times = [reftime + dt.timedelta(hours=h) for h in hours]
+                first, last = ds.indexes["time"].get_indexer(times, method="nearest")
+                dataset = dataset.isel(time=slice(first, last + 1))
+        else:
+            time = key[3]
+            ds = self.dataset(gfs_hist_url(date, run, time, self.hist_base_url))
+            dataset = ds[list(varlist)]
+
+        dataset = select_region(dataset, lat, lon)
+        dataset = coarsen_dataset(dataset, coarsen, coarsen_mode).load()
+
+        logging.info(f"Extracted {dict(dataset.sizes)} from {kind} {date} {run:02d}")
+        return encode(dataset, fmt)
+
+    def info(self):
+        with self._lock:
+            return dict(
+                self.stats,
+                cached=len(self._results),
+                cached_bytes=self._nbytes,
+                open_datasets=len(self._datasets),
+                in_flight=len(self._pending),
+            )
+
+
+def encode(dataset: xr.Dataset, fmt: str):
+    if fmt == "csv":
+        return dataset.to_dataframe().to_csv(float_format="%.3f").encode()
+
+    # The encoding of the server (for instance "days since 1-1-1" for the
+    # time) does not need to be valid for the extracted data
+    dataset = dataset.copy()
+    for var in dataset.variables.values():
+        var.encoding = {}
+
+    fd, tmp = tempfile.mkstemp(suffix=".nc")
+    os.close(fd)
+    try:
+        dataset.to_netcdf(tmp)
+        with open(tmp, "rb") as f:
+            return f.read()
+    finally:
+        os.remove(tmp)
+
+
+class ExtractionHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        kind = url.path.strip("/")
+        extractor = self.server.extractor
+
+        if kind == "stats":
+            return self.reply(200, json.dumps(extractor.info()).encode(), "json")
+        if kind not in ("realtime", "hist"):
+            return self.reply(404, b"Unknown endpoint\n")
+
+        try:
+            key = parse_request(kind, parse_qs(url.query))
+        except ValueError as err:
+            return self.reply(400, f"{err}\n".encode())
+
+        try:
+            body = extractor.get(key)
+        except KeyError as err:
+            return self.reply(404, f"Unknown variable {err}\n".encode())
+        except Exception as err:
+            logging.exception(err)
+            return self.reply(502, f"{err}\n".encode())
+
+        self.reply(200, body, key[-1])
+
+    def reply(self, code, body, fmt=None):
+        self.send_response(code)
+        self.send_header("Content-Type", CONTENT_TYPES.get(fmt, "text/plain"))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.info(f"{self.address_string()} {format % args}")
+
+
+def main(
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    base_url: str = GFS_BASE,
+    hist_base_url: str = GFS_HIST_BASE,
+    cache_mb: int = 256,
+    max_open: int = 16,
+    log: str = "info",
+):
+    """Serve the extraction of regions of the forecasts over HTTP, for instance
+    /realtime?date=20210217&hour=6&vars=ugrd10m,vgrd10m&lat=35,45&lon=-10,5
+    (see the README for all the parameters, and /stats for the cache usage)"""
+
+    set_logging(log)
+
+    server = ThreadingHTTPServer((host, port), ExtractionHandler)
+    server.daemon_threads = True
+    server.extractor = Extractor(base_url, hist_base_url, cache_mb * 2**20, max_open)
+
+    logging.info(f"Listening on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -3,10 +3,13 @@
 """ Download meteorological files from GFS """
 import argparse
 import json
-import os
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import partial
 from inspect import getmembers
+from itertools import groupby
 from traceback import print_exc
 
 import numpy as np
@@ -14,12 +17,23 @@ import pandas as pd
 from pydap.client import open_dods
 from pydap.exceptions import OpenFileError, ServerError
 
+from gfsget.checkpoint import Checkpoint, is_done
+from gfsget.derived import add_derived, split_config
+from gfsget.pack import merge_errors, split_pack, summary, to_csv_packed
+
 URL = "https://nomads.ncep.noaa.gov/dods/gfs_{res}{step}/gfs{date}/gfs_{res}{step}_{hour:02d}z.dods?"
 
-FORMAT_STR = (
-    "{var}.{var}[{time[0]:d}:{time[1]:d}][{lat[0]:d}:{lat[1]:d}][{lon[0]:d}:{lon[1]:d}]"
-)
-FORMAT_STR_PL = "{var}.{var}[{time[0]:d}:{time[1]:d}][{lev[0]:d}:{lev[1]:d}][{lat[0]:d}:{lat[1]:d}][{lon[0]:d}:{lon[1]:d}]"
+# GEFS members (gec00 control, gep01-gep30 perturbed) share the grid and
+# variable names of GFS, at 0.5º and 3h
+URL_ENS = "https://nomads.ncep.noaa.gov/dods/gefs/gefs{date}/{member}_{hour:02d}z_pgrb2ap5.dods?"
+ENS_STEP = 3
+ENS_MEMBERS = (0, 30)
+
+# Hyperslabs [start:stride:stop], the server only sends every stride-th cell
+FORMAT_STR = "{var}.{var}[{time[0]:d}:{time[1]:d}][{lat[0]:d}:{stride:d}:{lat[1]:d}][{lon[0]:d}:{stride:d}:{lon[1]:d}]"
+FORMAT_STR_PL = "{var}.{var}[{time[0]:d}:{time[1]:d}][{lev[0]:d}:{lev[1]:d}][{lat[0]:d}:{stride:d}:{lat[1]:d}][{lon[0]:d}:{stride:d}:{lon[1]:d}]"
+
+COARSEN_MODES = ("subsample", "block-mean")
 
 VAR_CONF = {
     "pressfc": "surface",
@@ -43,6 +57,29 @@ DATE_FORMAT = "%Y%m%d"
 range1 = lambda start, end, step=1: range(start, end + 1, step)
 
 
+def east_start(first_w, nlon, stride):
+    """First index of the eastern half of a request that crosses the 0
+    meridian, so that the stride continues from the western half"""
+    return (first_w - nlon) % stride
+
+
+def block_mean(values, shape, n):
+    """Average n x n blocks of a (nlat * nlon, ncol) array of a (nlat, nlon)
+    grid. Rows and columns at the end that do not fill a block are dropped."""
+    nlat, nlon = shape
+    mlat, mlon = nlat // n, nlon // n
+    if mlat == 0 or mlon == 0:
+        raise ValueError("Grid smaller than the coarsening block", shape, n)
+    grid = values.reshape(nlat, nlon, -1)[: mlat * n, : mlon * n]
+    return grid.reshape(mlat, n, mlon, n, -1).mean(axis=(1, 3)).reshape(mlat * mlon, -1)
+
+
+def block_coords(coords, n):
+    """Center of each block of n coordinates"""
+    m = len(coords) // n
+    return np.asarray(coords)[: m * n].reshape(m, n).mean(axis=1).tolist()
+
+
 def daterange(start, end):
     def convert(date):
         try:
@@ -116,36 +153,34 @@ def get_file(request, param, var_conf, time, lat, lon, verbose=False):
         for n in range(var_data[idx].shape[1])
     ]
 
+    data = np.concatenate(var_data, axis=1)
+
     index = pd.MultiIndex.from_product((lat, lon), names=["lat", "lon"])
     columns = pd.MultiIndex.from_product((time, var_names), names=["time", "var"])
 
     return pd.DataFrame(
-        (np.concatenate(var_data, axis=1).transpose(2, 0, 1).reshape(ncoord, -1)),
+        data.transpose(2, 0, 1).reshape(ncoord, -1),
         index=index,
         columns=columns,
     )
 
 
-def save_dataset(
-    fname,
-    date,
-    hour,
-    var_conf,
-    res,
-    step,
+def get_grid(
+    request,
     time_tuple,
+    step,
     lev_idx,
     lat_tuple,
     lon_tuple,
+    stride=1,
     verbose=False,
 ):
+    """Compute the hyperslab indices of a request from the grid in the server
 
-    request = URL.format(
-        date=date,
-        hour=hour,
-        res="{0:.2f}".format(res).replace(".", "p"),
-        step="" if step == 3 else "_{:1d}hr".format(step),
-    )
+    Returns the time steps, the latitudes and a list of (param, lon) with the
+    indices and longitudes of each request: two of them if the longitudes
+    cross the 0 meridian, since the server grid goes from 0 to 360.
+    """
 
     if verbose:
         print(request + "lat,lon")
@@ -176,30 +211,26 @@ def save_dataset(
     except:
         raise ValueError("Latitude not in the grid", lat_tuple)
 
-    lat = lat[range1(*lat_idx)].tolist()
+    lat = lat[range1(*lat_idx, step=stride)].tolist()
+
+    param = {"lat": lat_idx, "time": time_idx, "lev": lev_idx, "stride": stride}
 
     if lon_tuple[0] < 0 and lon_tuple[1] > 0:
         try:
             lon_idx_w = (lon_list.index(lon_tuple[0]), len(lon_list) - 1)
-            lon_idx_e = (0, lon_list.index(lon_tuple[1]))
+            lon_idx_e = (
+                east_start(lon_idx_w[0], len(lon_list), stride),
+                lon_list.index(lon_tuple[1]),
+            )
         except:
             raise ValueError("Longitude not in the grid", lon_tuple)
 
-        lon_w = lon[range1(*lon_idx_w)].tolist()
-        lon_e = lon[range1(*lon_idx_e)].tolist()
+        lon_w = lon[range1(*lon_idx_w, step=stride)].tolist()
+        lon_e = lon[range1(*lon_idx_e, step=stride)].tolist()
 
-        param_w = {"lat": lat_idx, "lon": lon_idx_w, "time": time_idx, "lev": lev_idx}
-        param_e = {"lat": lat_idx, "lon": lon_idx_e, "time": time_idx, "lev": lev_idx}
-        try:
-            data_w = get_file(
-                request, param_w, var_conf, time, lat, lon_w, verbose=verbose
-            )
-            data_e = get_file(
-                request, param_e, var_conf, time, lat, lon_e, verbose=verbose
-            )
-        except:
-            raise
-        data = pd.concat((data_w, data_e), axis=0)
+        param_w = dict(param, lon=lon_idx_w)
+        param_e = dict(param, lon=lon_idx_e)
+        pieces = [(param_w, lon_w), (param_e, lon_e)]
 
     else:
         try:
@@ -207,15 +238,262 @@ def save_dataset(
         except:
             raise ValueError("Longitude not in the grid", lon_tuple)
 
-        lon = lon[range1(*lon_idx)].tolist()
+        lon = lon[range1(*lon_idx, step=stride)].tolist()
 
-        param = {"lat": lat_idx, "lon": lon_idx, "time": time_idx, "lev": lev_idx}
-        try:
-            data = get_file(request, param, var_conf, time, lat, lon, verbose=verbose)
-        except:
-            raise
+        pieces = [(dict(param, lon=lon_idx), lon)]
+
+    return time, lat, pieces
+
+
+def var_groups(var_conf):
+    """Split the variables into groups of consecutive variables of the same
+    type, which are requested separately"""
+    return [
+        (vartype, dict(items))
+        for vartype, items in groupby(var_conf.items(), key=lambda item: item[1])
+    ]
+
+
+def get_data(
+    request,
+    var_conf,
+    time,
+    lat,
+    pieces,
+    block=1,
+    derived_conf=None,
+    drop_raw=False,
+    checkpoint=None,
+    prefix="",
+    verbose=False,
+):
+    """Download the data of every piece of the grid into a single DataFrame
+
+    Each group of variables and each piece of the grid is a separate request,
+    saved as a fragment of the checkpoint (named with the prefix), if any.
+    The derived variables are computed once all the pieces are joined. With
+    block > 1, blocks of block x block cells are averaged, and the derived
+    variables are computed afterwards from the averaged fields.
+    """
+
+    def fetch(name, *args):
+        if checkpoint is None:
+            return get_file(*args, verbose=verbose)
+        return checkpoint.load(prefix + name, get_file, *args, verbose=verbose)
+
+    groups = var_groups(var_conf)
+    data_list = []
+    for n, (param, lon) in enumerate(pieces):
+        frames = [
+            fetch(f"{vartype}{g}_lon{n}", request, param, group, time, lat, lon)
+            for g, (vartype, group) in enumerate(groups)
+        ]
+        # Same column order as a single request with all the variables
+        var_names = [name for frame in frames for name in frame.columns.unique("var")]
+        columns = pd.MultiIndex.from_product((time, var_names), names=["time", "var"])
+        data_list.append(pd.concat(frames, axis=1).reindex(columns=columns))
+
+    data = pd.concat(data_list, axis=0)
+
+    if block > 1:
+        lon = [value for _, lon_piece in pieces for value in lon_piece]
+        data = data.reindex(
+            pd.MultiIndex.from_product((lat, lon), names=["lat", "lon"])
+        )
+        index = pd.MultiIndex.from_product(
+            (block_coords(lat, block), block_coords(lon, block)), names=["lat", "lon"]
+        )
+        data = pd.DataFrame(
+            block_mean(data.values, (len(lat), len(lon)), block),
+            index=index,
+            columns=data.columns,
+        )
+
+    return add_derived(data, derived_conf, drop_raw)
 
-    data.to_csv(fname, sep=" ", float_format="%.3f")
+
+def coarsen_args(coarsen, coarsen_mode):
+    """Server stride and block size for a coarsening factor and mode"""
+    if coarsen_mode not in COARSEN_MODES:
+        raise ValueError("Unknown coarsening mode", coarsen_mode)
+    if coarsen_mode == "subsample":
+        return {"stride": coarsen}, {"block": 1}
+    return {"stride": 1}, {"block": coarsen}
+
+
+def publish(checkpoint, data, pack=None):
+    """Write the output of a job, packed with the rules and compressed if pack
+    is not None. Returns the summary of the packing, if any"""
+    if pack is None:
+        checkpoint.publish(lambda f: data.to_csv(f, sep=" ", float_format="%.3f"))
+        return None
+
+    errors = {}
+    checkpoint.publish(lambda f: errors.update(to_csv_packed(data, f, pack)), "wb")
+    return summary(checkpoint.fname, data.values.nbytes, errors)
+
+
+def save_dataset(
+    fname,
+    date,
+    hour,
+    var_conf,
+    res,
+    step,
+    time_tuple,
+    lev_idx,
+    lat_tuple,
+    lon_tuple,
+    coarsen=1,
+    coarsen_mode="subsample",
+    derived_conf=None,
+    drop_raw=False,
+    pack=None,
+    resume=True,
+    verbose=False,
+):
+
+    grid_args, data_args = coarsen_args(coarsen, coarsen_mode)
+
+    request = URL.format(
+        date=date,
+        hour=hour,
+        res="{0:.2f}".format(res).replace(".", "p"),
+        step="" if step == 3 else "_{:1d}hr".format(step),
+    )
+
+    time, lat, pieces = get_grid(
+        request,
+        time_tuple,
+        step,
+        lev_idx,
+        lat_tuple,
+        lon_tuple,
+        verbose=verbose,
+        **grid_args,
+    )
+
+    # The fragments only depend on the requests, so they are also resumed if
+    # the derived variables change
+    checkpoint = Checkpoint(fname, [request, var_conf, pieces], resume)
+    if verbose and checkpoint.resumed:
+        print("Resuming with {0} downloaded parts".format(checkpoint.resumed))
+
+    data = get_data(
+        request,
+        var_conf,
+        time,
+        lat,
+        pieces,
+        **data_args,
+        derived_conf=derived_conf,
+        drop_raw=drop_raw,
+        checkpoint=checkpoint,
+        verbose=verbose,
+    )
+
+    return publish(checkpoint, data, pack)
+
+
+def member_name(member):
+    """Name of a GEFS member in the server: control (0) or perturbed run"""
+    return "gec00" if member == 0 else "gep{:02d}".format(member)
+
+
+def save_ensemble(
+    fname,
+    date,
+    hour,
+    var_conf,
+    members,
+    time_tuple,
+    lev_idx,
+    lat_tuple,
+    lon_tuple,
+    max_members=4,
+    coarsen=1,
+    coarsen_mode="subsample",
+    derived_conf=None,
+    drop_raw=False,
+    pack=None,
+    resume=True,
+    verbose=False,
+):
+    """Download several GEFS members into a single file
+
+    The rows of the output have a (member, lat, lon) index. Every member has
+    the same grid, so the hyperslab indices are computed only once. Members
+    are downloaded concurrently, with at most max_members in flight, and are
+    written in order as soon as they arrive, so memory does not grow with the
+    number of members. Every member is saved as fragments of the checkpoint,
+    so an interrupted download only requests the missing ones again. With
+    pack, members are packed and appended to the file as gzip members.
+    """
+
+    grid_args, data_args = coarsen_args(coarsen, coarsen_mode)
+
+    requests = [
+        URL_ENS.format(date=date, hour=hour, member=member_name(member))
+        for member in members
+    ]
+
+    time, lat, pieces = get_grid(
+        requests[0],
+        time_tuple,
+        ENS_STEP,
+        lev_idx,
+        lat_tuple,
+        lon_tuple,
+        verbose=verbose,
+        **grid_args,
+    )
+
+    checkpoint = Checkpoint(fname, [requests, var_conf, pieces], resume)
+    if verbose and checkpoint.resumed:
+        print("Resuming with {0} downloaded parts".format(checkpoint.resumed))
+
+    fetch = partial(
+        get_data,
+        var_conf=var_conf,
+        time=time,
+        lat=lat,
+        pieces=pieces,
+        **data_args,
+        derived_conf=derived_conf,
+        drop_raw=drop_raw,
+        checkpoint=checkpoint,
+        verbose=verbose,
+    )
+
+    nbytes, errors = 0, {}
+
+    def write(f, member, future):
+        nonlocal nbytes
+        data = pd.concat({member: future.result()}, names=["member"])
+        if pack is None:
+            data.to_csv(f, sep=" ", float_format="%.3f", header=f.tell() == 0)
+        else:
+            merge_errors(errors, to_csv_packed(data, f, pack, header=f.tell() == 0))
+            nbytes += data.values.nbytes
+
+    def write_members(f):
+        with ThreadPoolExecutor(max_members) as executor:
+            pending = deque()
+            for member, request in zip(members, requests):
+                prefix = member_name(member) + "_"
+                future = executor.submit(fetch, request, prefix=prefix)
+                pending.append((member, future))
+                if len(pending) == max_members:
+                    write(f, *pending.popleft())
+            while pending:
+                write(f, *pending.popleft())
+
+    if pack is None:
+        checkpoint.publish(write_members)
+        return None
+
+    checkpoint.publish(write_members, "wb")
+    return summary(fname, nbytes, errors)
 
 
 def main(args):
@@ -269,6 +547,58 @@ def main(args):
         default=None,
         metavar=("VAR_CONF"),
     )
+    parser.add_argument(
+        "-k",
+        "--coarsen",
+        help="keep one of every N cells in lat and lon [Default: %(default)s]",
+        type=int,
+        default=1,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--coarsen-mode",
+        help="subsample: the server sends every N-th cell, block-mean: average "
+        "N x N blocks after downloading [Default: %(default)s]",
+        choices=COARSEN_MODES,
+        default="subsample",
+        dest="coarsen_mode",
+    )
+    parser.add_argument(
+        "-E",
+        "--ensemble",
+        help="download GEFS ensemble members (0.5º and 3h) instead of GFS",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-m",
+        "--members",
+        help="ensemble members, 0 is the control run [Default: %(default)s]",
+        type=int,
+        nargs=2,
+        default=ENS_MEMBERS,
+        metavar=("FIRST", "LAST"),
+    )
+    parser.add_argument(
+        "-j",
+        "--max-members",
+        help="ensemble members downloaded at the same time [Default: %(default)s]",
+        type=int,
+        default=4,
+        dest="max_members",
+    )
+    parser.add_argument(
+        "-z",
+        "--pack",
+        help="pack the variables with the rules of the configuration and "
+        "compress the output (DATE_HOUR.gz)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--drop-raw",
+        help="do not write the variables used to compute the derived ones",
+        action="store_true",
+        dest="drop_raw",
+    )
     parser.add_argument(
         "-r",
         "--res",
@@ -320,6 +650,22 @@ def main(args):
         with open(args.conf, "r") as f:
             var_conf = json.load(f)
 
+    var_conf, derived_conf = split_config(var_conf)
+    var_conf, pack_rules = split_pack(var_conf)
+    pack = pack_rules if args.pack else None
+
+    if args.coarsen < 1:
+        sys.exit("The coarsening factor has to be positive")
+
+    if args.ensemble:
+        if args.members[0] < ENS_MEMBERS[0] or args.members[1] > ENS_MEMBERS[1]:
+            sys.exit("Ensemble members not in range {0}..{1}".format(*ENS_MEMBERS))
+        if args.members[0] > args.members[1]:
+            sys.exit("First ensemble member has to be lower than the last")
+        if args.max_members < 1:
+            sys.exit("At least one ensemble member has to be downloaded at a time")
+        members = list(range1(*args.members))
+
     end_date = args.end_date if args.end_date else args.date
     hour_range = args.hour if type(args.hour) is tuple else (args.hour,)
 
@@ -328,26 +674,57 @@ def main(args):
         for hour in hour_range:
             date_str = date.strftime(DATE_FORMAT)
             fname = "{0}/{1}_{2:02d}".format(args.output, date_str, hour)
+            if args.ensemble:
+                fname += "_ens"
+            if args.pack:
+                fname += ".gz"
 
-            if not args.force and os.path.isfile(fname):
+            if not args.force and is_done(fname):
                 print("File {0} already exists".format(fname))
             else:
                 try:
                     print("Downloading {0} {1:02d}...".format(date_str, hour))
                     sys.stdout.flush()
-                    save_dataset(
-                        fname,
-                        date_str,
-                        hour,
-                        var_conf,
-                        args.res,
-                        args.step,
-                        args.time,
-                        args.pl,
-                        args.lat,
-                        args.lon,
-                        verbose=args.verbose,
-                    )
+                    if args.ensemble:
+                        report = save_ensemble(
+                            fname,
+                            date_str,
+                            hour,
+                            var_conf,
+                            members,
+                            args.time,
+                            args.pl,
+                            args.lat,
+                            args.lon,
+                            max_members=args.max_members,
+                            coarsen=args.coarsen,
+                            coarsen_mode=args.coarsen_mode,
+                            derived_conf=derived_conf,
+                            drop_raw=args.drop_raw,
+                            pack=pack,
+                            resume=not args.force,
+                            verbose=args.verbose,
+                        )
+                    else:
+                        report = save_dataset(
+                            fname,
+                            date_str,
+                            hour,
+                            var_conf,
+                            args.res,
+                            args.step,
+                            args.time,
+                            args.pl,
+                            args.lat,
+                            args.lon,
+                            coarsen=args.coarsen,
+                            coarsen_mode=args.coarsen_mode,
+                            derived_conf=derived_conf,
+                            drop_raw=args.drop_raw,
+                            pack=pack,
+                            resume=not args.force,
+                            verbose=args.verbose,
+                        )
                 except (ValueError, TypeError) as err:
                     print()
                     print_exc()
@@ -361,6 +738,8 @@ def main(args):
                     print_exc()
                 else:
                     print("done!")
+                    if report:
+                        print(report)
     return 0
 
 
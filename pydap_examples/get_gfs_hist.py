@@ -3,7 +3,6 @@
 """ Descarga ficheros de meteorología del servidor histórico del GFS """
 import argparse
 import json
-import os
 import sys
 from traceback import format_exc, print_exc
 
@@ -12,17 +11,31 @@ import pandas as pd
 from pydap.client import open_dods
 from pydap.exceptions import ServerError
 
-sys.path.append(".")
-from get_gfs import daterange, lat_type, lon_type, range1
+from gfsget.checkpoint import Checkpoint, is_done
+from gfsget.derived import add_derived, split_config
+from gfsget.pack import merge_errors, split_pack, summary, to_csv_packed
+from gfsget.interp import METHODS, interpolate_steps
+
+from get_gfs import (
+    COARSEN_MODES,
+    block_coords,
+    block_mean,
+    daterange,
+    east_start,
+    lat_type,
+    lon_type,
+    range1,
+)
 
 URL = "https://www.ncei.noaa.gov/thredds/dodsC/model-gfs-004-files-old/{0}_{1:03d}.grb2.dods?"
 DIR = "{0}/{1}/gfs_4_{1}_{2:02d}00"
-FORMAT_STR = "{var}.{var}[0][{lat[0]}:{lat[1]}][{lon[0]}:{lon[1]}]"
-FORMAT_STR_PL = (
-    "{var}.{var}[0][{lev[0]}:{lev[1]}][{lat[0]}:{lat[1]}][{lon[0]}:{lon[1]}]"
-)
+FORMAT_STR = "{var}.{var}[0][{lat[0]}:{stride}:{lat[1]}][{lon[0]}:{stride}:{lon[1]}]"
+FORMAT_STR_PL = "{var}.{var}[0][{lev[0]}:{lev[1]}][{lat[0]}:{stride}:{lat[1]}][{lon[0]}:{stride}:{lon[1]}]"
 DATE_FORMAT = "%Y%m%d"
 
+# Values of the output written at once (32 MB of float64)
+BLOCK_VALUES = 2**22
+
 VARS = {
     "Pressure_surface": {"type": "surface"},
     "U-component_of_wind_height_above_ground": {
@@ -44,22 +57,26 @@ VARS = {
 }
 
 
-def get_sequential(file, time, var_config, lat_idx, lon_idx, verbose=False):
+def get_sequential(file, time, var_config, lat_idx, lon_idx, stride=1, verbose=False):
 
     var_list = []
     nlev_dict = {}
     for var, config in var_config.items():
         if config["type"] == "surface":
-            var_list.append(FORMAT_STR.format(var=var, lat=lat_idx, lon=lon_idx))
+            var_list.append(
+                FORMAT_STR.format(var=var, lat=lat_idx, lon=lon_idx, stride=stride)
+            )
             nlev_dict[var] = 1
         else:
             lev_idx = tuple(config["levels"])
             var_list.append(
-                FORMAT_STR_PL.format(var=var, lev=lev_idx, lat=lat_idx, lon=lon_idx)
+                FORMAT_STR_PL.format(
+                    var=var, lev=lev_idx, lat=lat_idx, lon=lon_idx, stride=stride
+                )
             )
             nlev_dict[var] = lev_idx[1] - lev_idx[0] + 1
 
-    ncoord = (lat_idx[1] - lat_idx[0] + 1) * (lon_idx[1] - lon_idx[0] + 1)
+    ncoord = len(range1(*lat_idx, step=stride)) * len(range1(*lon_idx, step=stride))
 
     request = URL.format(file, time) + ",".join(var_list)
 
@@ -76,86 +93,98 @@ def get_sequential(file, time, var_config, lat_idx, lon_idx, verbose=False):
             var.data.reshape(nlev_dict[var.name], ncoord).T,
             columns=["{}{}".format(var.name, n) for n in range(nlev_dict[var.name])],
         )
-        for var in dataset
+        for var in dataset.values()
     ]
 
     return pd.concat(var_data, axis=1)
 
 
-def get_general(file, time, var_config, lat_idx, lon_idx_w, lon_idx_e, verbose=False):
-
-    request = URL.format(file, time)
-
-    var_w_list, var_e_list = [], []
-    nlev_dict = {}
-    for var, config in var_config.items():
-        if config["type"] == "surface":
-            var_w_list.append(FORMAT_STR.format(var=var, lat=lat_idx, lon=lon_idx_w))
-            var_e_list.append(FORMAT_STR.format(var=var, lat=lat_idx, lon=lon_idx_e))
-            nlev_dict[var] = 1
-        else:
-            lev_idx = tuple(config["levels"])
-            var_w_list.append(
-                FORMAT_STR_PL.format(var=var, lev=lev_idx, lat=lat_idx, lon=lon_idx_w)
-            )
-            var_e_list.append(
-                FORMAT_STR_PL.format(var=var, lev=lev_idx, lat=lat_idx, lon=lon_idx_e)
-            )
-            nlev_dict[var] = lev_idx[1] - lev_idx[0] + 1
+def join_lon(west, east, nlat):
+    """Join the western and eastern parts of a step along the longitudes
 
-    ncoord = (lat_idx[1] - lat_idx[0] + 1) * (
-        (lon_idx_w[1] - lon_idx_w[0] + 1) + (lon_idx_e[1] - lon_idx_e[0] + 1)
+    The rows of both parts are in (lat, lon) grid order, so the step has the
+    rows of the western part of each latitude followed by the eastern ones.
+    """
+    ncol = west.shape[1]
+    values = np.concatenate(
+        (west.values.reshape(nlat, -1, ncol), east.values.reshape(nlat, -1, ncol)),
+        axis=1,
     )
+    return pd.DataFrame(values.reshape(-1, ncol), columns=west.columns)
 
-    request_w = request + ",".join(var_w_list)
-    request_e = request + ",".join(var_e_list)
 
-    if verbose:
-        print(request_w)
-        print(request_e)
+def publish_steps(checkpoint, times, columns, index, pack=None):
+    """Write the output of a job from the steps saved as fragments s000,
+    s001, ... of the checkpoint, in blocks of rows sorted by (lat, lon)
 
-    try:
-        dataset_w = open_dods(request_w)
-        dataset_e = open_dods(request_e)
-    except:
-        raise
+    The steps are memory mapped, so only one block of the output is kept in
+    memory. Returns the summary of the packing, if any.
+    """
+    order = np.lexsort((index.get_level_values(1), index.get_level_values(0)))
+    columns = pd.MultiIndex.from_tuples(
+        [(time, var) for time in times for var in columns], names=["time", "var"]
+    )
+    nrows = max(1, BLOCK_VALUES // len(columns))
+    nbytes, errors = 0, {}
+
+    def write(f):
+        nonlocal nbytes
+        steps = [checkpoint.load_array("s{0:03d}".format(n)) for n in range(len(times))]
+        for start in range(0, len(order), nrows):
+            rows = order[start : start + nrows]
+            block = pd.DataFrame(
+                np.concatenate([step[rows] for step in steps], axis=1),
+                index=index[rows],
+                columns=columns,
+            )
+            if pack is None:
+                block.to_csv(f, sep=" ", float_format="%.3f", header=start == 0)
+            else:
+                merge_errors(errors, to_csv_packed(block, f, pack, header=start == 0))
+                nbytes += block.values.nbytes
 
-    # 1. Concatenate both 'west' and 'east' data along 'lon' axis (last axis)
-    # 2. Reshape 4D-array (1, nlev, nlat, nlon) to 2D-array (nlev, nlat*nlon)
-    # 3. Transpose and store in DataFrame
-    # This is ugly :(, partly because the long function names
-    var_data = [
-        pd.DataFrame(
-            (
-                np.concatenate(
-                    (var_w.data[0], var_e.data[0]), axis=len(var_w.data[0].shape) - 1
-                )
-                .reshape(nlev_dict[var_w.name], ncoord)
-                .T
-            ),
-            columns=[
-                "{}{}".format(var_w.name, n) for n in range(nlev_dict[var_w.name])
-            ],
-        )
-        for var_w, var_e in zip(dataset_w.values(), dataset_e.values())
-    ]
+    if pack is None:
+        checkpoint.publish(write)
+        return None
 
-    # 4. Concatenate the DataFrames for each var to obtain a single DataFrame
-    #    with (nlat*nlon, nlev*nvar) Note every var can have a different number
-    #    of levels (either pressure levels or height above ground levels)
-    return pd.concat(var_data, axis=1)
+    checkpoint.publish(write, "wb")
+    return summary(checkpoint.fname, nbytes, errors)
 
 
 def save_dataset(
-    hour, date, var_config, time_tuple, lat_tuple, lon_tuple, fname, verbose=False
+    hour,
+    date,
+    var_config,
+    time_tuple,
+    lat_tuple,
+    lon_tuple,
+    fname,
+    coarsen=1,
+    coarsen_mode="subsample",
+    derived_conf=None,
+    drop_raw=False,
+    interp_step=None,
+    interp_method="linear",
+    pack=None,
+    resume=True,
+    verbose=False,
 ):
-    """Download the datasets for a specific date and hour"""
+    """Download the datasets for a specific date and hour
+
+    Every step (or western and eastern part of a step) is saved as a
+    fragment of the checkpoint as soon as it is downloaded, so an interrupted
+    download only requests the missing steps again.
+    """
 
     date_str = date.strftime("%Y%m%d")
     month_str = date.strftime("%Y%m")
 
     file = DIR.format(month_str, date_str, hour)
 
+    if coarsen_mode not in COARSEN_MODES:
+        raise ValueError("Unknown coarsening mode", coarsen_mode)
+    stride = coarsen if coarsen_mode == "subsample" else 1
+
     time_list = list(range1(time_tuple[0], time_tuple[1], 3))
 
     # Get the lat and lon grids from the first dataset present in the server
@@ -192,54 +221,87 @@ def save_dataset(
     except:
         raise ValueError("Latitude not in the grid", lat_tuple)
 
-    lat = lat[range1(*lat_idx)].tolist()
+    lat = lat[range1(*lat_idx, step=stride)].tolist()
 
     if lon_tuple[0] < 0 and lon_tuple[1] > 0:
         try:
             lon_idx_w = (lon_list.index(lon_tuple[0]), len(lon_list) - 1)
-            lon_idx_e = (0, lon_list.index(lon_tuple[1]))
+            lon_idx_e = (
+                east_start(lon_idx_w[0], len(lon_list), stride),
+                lon_list.index(lon_tuple[1]),
+            )
         except:
             raise ValueError("Longitude not in the grid", lon_tuple)
         lon = np.concatenate(
-            (lon[range1(*lon_idx_w)], lon[range1(*lon_idx_e)])
+            (lon[range1(*lon_idx_w, step=stride)], lon[range1(*lon_idx_e, step=stride)])
         ).tolist()
-
-        try:
-            data_list = [
-                get_general(
-                    file,
-                    time,
-                    var_config,
-                    lat_idx,
-                    lon_idx_w,
-                    lon_idx_e,
-                    verbose=verbose,
-                )
-                for time in time_list
-            ]
-        except:
-            raise
+        parts = [("_w", lon_idx_w), ("_e", lon_idx_e)]
 
     else:
         try:
             lon_idx = (lon_list.index(lon_tuple[0]), lon_list.index(lon_tuple[1]))
         except:
             raise ValueError("Longitude not in the grid", lon_tuple)
-        lon = lon[range1(*lon_idx)].tolist()
-        try:
-            data_list = [
-                get_sequential(
-                    file, time, var_config, lat_idx, lon_idx, verbose=verbose
-                )
-                for time in time_list
-            ]
-        except:
-            raise
+        lon = lon[range1(*lon_idx, step=stride)].tolist()
+        parts = [("", lon_idx)]
 
-    data = pd.concat(data_list, axis=1, keys=time_list, names=["time", "var"])
-    data.index = pd.MultiIndex.from_product((lat, lon), names=["lat", "lon"])
-    data.sort_index(inplace=True)
-    data.to_csv(fname, sep=" ", float_format="%.3f")
+    checkpoint = Checkpoint(
+        fname, [file, var_config, time_list, lat_idx, parts, stride], resume
+    )
+    if verbose and checkpoint.resumed:
+        print("Resuming with {0} downloaded parts".format(checkpoint.resumed))
+
+    # lat is replaced by the block centers below, before the steps are used
+    nlat = len(lat)
+
+    def get_step(time):
+        data = [
+            checkpoint.load(
+                "t{0:03d}{1}".format(time, suffix),
+                get_sequential,
+                file,
+                time,
+                var_config,
+                lat_idx,
+                lon_idx,
+                stride=stride,
+                verbose=verbose,
+            )
+            for suffix, lon_idx in parts
+        ]
+        return data[0] if len(data) == 1 else join_lon(*data, nlat)
+
+    # Generator, so that each step is downloaded only when it is needed
+    steps = ((time, get_step(time)) for time in time_list)
+
+    # Rows of each step are in (lat, lon) grid order, so blocks can be averaged
+    # as soon as the step is downloaded
+    if coarsen_mode == "block-mean" and coarsen > 1:
+        shape = (len(lat), len(lon))
+        steps = (
+            (
+                time,
+                pd.DataFrame(
+                    block_mean(data.values, shape, coarsen), columns=data.columns
+                ),
+            )
+            for time, data in steps
+        )
+        lat, lon = block_coords(lat, coarsen), block_coords(lon, coarsen)
+
+    if interp_step:
+        steps = interpolate_steps(steps, interp_step, interp_method)
+
+    # The (interpolated) steps are saved as they are computed, so only the
+    # last downloaded steps are kept in memory
+    times = []
+    for time, data in steps:
+        data = add_derived(data, derived_conf, drop_raw)
+        checkpoint.save_array("s{0:03d}".format(len(times)), data.to_numpy())
+        times.append(time)
+
+    index = pd.MultiIndex.from_product((lat, lon), names=["lat", "lon"])
+    return publish_steps(checkpoint, times, data.columns, index, pack)
 
 
 def main(args):
@@ -284,6 +346,51 @@ def main(args):
         default=None,
         metavar=("VAR_CONF"),
     )
+    parser.add_argument(
+        "-k",
+        "--coarsen",
+        help="keep one of every N cells in lat and lon [Default: %(default)s]",
+        type=int,
+        default=1,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--coarsen-mode",
+        help="subsample: the server sends every N-th cell, block-mean: average "
+        "N x N blocks after downloading [Default: %(default)s]",
+        choices=COARSEN_MODES,
+        default="subsample",
+        dest="coarsen_mode",
+    )
+    parser.add_argument(
+        "-i",
+        "--interp-step",
+        help="interpolate to a temporal resolution in hours [Default: no]",
+        type=int,
+        default=None,
+        dest="interp_step",
+        metavar="STEP",
+    )
+    parser.add_argument(
+        "--interp-method",
+        help="temporal interpolation method [Default: %(default)s]",
+        choices=METHODS,
+        default="linear",
+        dest="interp_method",
+    )
+    parser.add_argument(
+        "-z",
+        "--pack",
+        help="pack the variables with the rules of the configuration and "
+        "compress the output (DATE_HOUR.gz)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--drop-raw",
+        help="do not write the variables used to compute the derived ones",
+        action="store_true",
+        dest="drop_raw",
+    )
     parser.add_argument(
         "-e",
         "--end-date",
@@ -318,6 +425,12 @@ def main(args):
     if args.time[0] > args.time[1]:
         sys.exit("First time step has to be lower than the last")
 
+    if args.coarsen < 1:
+        sys.exit("The coarsening factor has to be positive")
+
+    if args.interp_step is not None and args.interp_step <= 0:
+        sys.exit("The interpolation step has to be positive")
+
     end_date = args.end_date if args.end_date else args.date
     hour_range = args.hour if type(args.hour) is tuple else (args.hour,)
 
@@ -327,16 +440,22 @@ def main(args):
         with open(args.config, "r") as f:
             var_config = json.load(f)
 
+    var_config, derived_conf = split_config(var_config)
+    var_config, pack_rules = split_pack(var_config)
+    pack = pack_rules if args.pack else None
+
     for date in daterange(args.date, end_date):
         for hour in hour_range:
 
             date_str = date.strftime(DATE_FORMAT)
             fname = "{0}/{1}_{2:02d}".format(args.output, date_str, hour)
+            if args.pack:
+                fname += ".gz"
 
-            if not os.path.isfile(fname) or args.force:
+            if not is_done(fname) or args.force:
                 try:
                     print("Downloading {0} {1:02d}...".format(date_str, hour), end=" ")
-                    save_dataset(
+                    report = save_dataset(
                         hour,
                         date,
                         var_config,
@@ -344,6 +463,14 @@ def main(args):
                         args.lat,
                         args.lon,
                         fname,
+                        coarsen=args.coarsen,
+                        coarsen_mode=args.coarsen_mode,
+                        derived_conf=derived_conf,
+                        drop_raw=args.drop_raw,
+                        interp_step=args.interp_step,
+                        interp_method=args.interp_method,
+                        pack=pack,
+                        resume=not args.force,
                         verbose=args.verbose,
                     )
                 except ServerError as err:
@@ -360,6 +487,8 @@ def main(args):
                     print_exc()
                 else:
                     print("done!")
+                    if report:
+                        print(report)
             else:
                 print(
                     "File {0} already exists (re-run with -f to overwrite)".format(
@@ -1,9 +1,20 @@
-#!/bin/env python
+#!/usr/bin/env python
 # -*- coding: UTF-8 -*-
+""" Compare the output of the real time and historical GFS servers """
+import argparse
+import gzip
+import json
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import zip_longest
+
 import numpy as np
 import pandas as pd
 
+from gfsget.checkpoint import is_artifact
+
 #      Historical variable                Real time variables
 MAP = {"Pressure_surface0":                        "pressfc0",
        "Temperature_height_above_ground0":         "tmp2m0",
@@ -21,15 +32,297 @@ MAP = {"Pressure_surface0":                        "pressfc0",
        "Geopotential_height0":                     "hgtprs0",
        "Geopotential_height1":                     "hgtprs1"}
 
+# Number of header lines: time, var and the lat/lon index names
+NHEADER = 3
+
+# Runs of rows in lat/lon order that are merged when reading a file (the real
+# time server writes the western half of the grid before the eastern one)
+MAX_RUNS = 16
+
+
+def read_header(fname):
+    """(time, var) of each data column, skipping the lat/lon index columns"""
+    opener = gzip.open if fname.endswith(".gz") else open
+    with opener(fname, "rt") as f:
+        times = f.readline().split()[1:]
+        names = f.readline().split()[1:]
+    return [(int(time), var) for time, var in zip(times, names)]
+
+
+def read_chunks(fname, chunksize, start=0, nrows=None):
+    """Iterate over the rows of an output file (nrows from row start) as 2D
+    float arrays, where the first two columns are lat and lon"""
+    reader = pd.read_csv(
+        fname,
+        sep=" ",
+        header=None,
+        skiprows=NHEADER + start,
+        nrows=nrows,
+        chunksize=chunksize,
+    )
+    for chunk in reader:
+        yield chunk.to_numpy(dtype=np.float64)
+
+
+def row_keys(rows):
+    """Integer key of each row from its lat/lon, to 3 decimals"""
+    if not len(rows):
+        return np.empty(0, dtype=np.int64)
+    lat = np.round(rows[:, 0] * 1000).astype(np.int64)
+    lon = np.round(rows[:, 1] * 1000).astype(np.int64)
+    return lat * 1000000 + lon
+
+
+def sorted_runs(fname):
+    """(first, last + 1) rows of each run of rows in increasing lat/lon order.
+    Only the lat and lon of the lines are parsed, and nothing is kept"""
+    opener = gzip.open if fname.endswith(".gz") else open
+    starts, last, nrows = [0], None, 0
+    with opener(fname, "rb") as f:
+        for _ in range(NHEADER):
+            f.readline()
+        for line in f:
+            # Blank lines are skipped by the readers as well
+            if not line.strip():
+                continue
+            lat, lon = line.split(b" ", 2)[:2]
+            key = round(float(lat) * 1000) * 1000000 + round(float(lon) * 1000)
+            if last is not None and key <= last:
+                starts.append(nrows)
+            last = key
+            nrows += 1
+    return list(zip(starts, starts[1:] + [nrows])) if nrows else []
+
+
+def read_sorted(fname, chunksize):
+    """Iterate over the rows of an output file in increasing lat/lon order
+
+    Every run of rows in lat/lon order is read with its own reader, and the
+    runs are merged, so about two chunks of rows are kept in memory. Files
+    with more than MAX_RUNS runs are read at once and sorted in memory.
+    """
+    runs = sorted_runs(fname)
+    if len(runs) <= 1:
+        yield from read_chunks(fname, chunksize)
+        return
+    if len(runs) > MAX_RUNS:
+        rows = np.concatenate(list(read_chunks(fname, chunksize)))
+        rows = rows[np.argsort(row_keys(rows), kind="stable")]
+        for start in range(0, len(rows), chunksize):
+            yield rows[start : start + chunksize]
+        return
+
+    size = max(1, chunksize // len(runs))
+    readers = [read_chunks(fname, size, start, stop - start) for start, stop in runs]
+    buffers = [next(reader) for reader in readers]
+    merged = np.empty((0, 0))
+    while readers:
+        # Rows up to the smallest of the last keys read from each run are
+        # complete, the next rows of every run come after them
+        bound = min(row_keys(rows[-1:])[0] for rows in buffers)
+        complete = []
+        for n, rows in enumerate(buffers):
+            cut = np.searchsorted(row_keys(rows), bound, side="right")
+            complete.append(rows[:cut])
+            buffers[n] = rows[cut:]
+        rows = np.concatenate(complete)
+        merged = append_rows(merged, rows[np.argsort(row_keys(rows), kind="stable")])
+
+        for n in reversed(range(len(readers))):
+            if not len(buffers[n]):
+                rows = next(readers[n], None)
+                if rows is None:
+                    del readers[n], buffers[n]
+                else:
+                    buffers[n] = rows
+
+        # Chunks of the same size as a sorted file, so the rows of both files
+        # are read at the same pace
+        while len(merged) >= chunksize or (merged.size and not readers):
+            yield merged[:chunksize]
+            merged = merged[chunksize:]
+
+
+def behind(rows, last):
+    """Whether the first of the rows comes before the key last"""
+    return len(rows) > 0 and last is not None and row_keys(rows[:1])[0] <= last
+
+
+def append_rows(rows, chunk):
+    if not len(rows):
+        return chunk
+    if not len(chunk):
+        return rows
+    return np.concatenate((rows, chunk))
+
+
+def compare_pair(fname_rt, fname_hist, mapping=MAP, chunksize=100000):
+    """Accumulate the differences between two output files chunk by chunk
+
+    Returns a DataFrame indexed by (var, time) with the number of values, the
+    sum of the differences (real time - historical), the sum of the squared
+    differences and the maximum absolute difference, so that the results of
+    several files can be combined later.
+    """
+    columns_rt = read_header(fname_rt)
+    columns_hist = [
+        (time, mapping.get(var, var)) for time, var in read_header(fname_hist)
+    ]
+
+    position_hist = {column: idx for idx, column in enumerate(columns_hist)}
+    common = [column for column in columns_rt if column in position_hist]
+    if not common:
+        raise ValueError("No common variables", fname_rt, fname_hist)
+
+    idx_rt = np.array([columns_rt.index(column) for column in common]) + 2
+    idx_hist = np.array([position_hist[column] for column in common]) + 2
+
+    count = np.zeros(len(common), dtype=np.int64)
+    total = np.zeros(len(common))
+    total_sq = np.zeros(len(common))
+    max_err = np.full(len(common), np.nan)
+
+    # Rows are matched by lat/lon, since the files do not need to have the same
+    # row order (the real time server writes the western half first). Both
+    # files are read in lat/lon order, so the rows without a pair yet are the
+    # ones after the last row read from the other file, about a chunk
+    pending_rt = pending_hist = np.empty((0, 0))
+    last_rt = last_hist = None
+    chunks = zip_longest(
+        read_sorted(fname_rt, chunksize),
+        read_sorted(fname_hist, chunksize),
+        fillvalue=np.empty((0, 0)),
+    )
+    for chunk_rt, chunk_hist in chunks:
+        pending_rt = append_rows(pending_rt, chunk_rt)
+        pending_hist = append_rows(pending_hist, chunk_hist)
+        if len(chunk_rt):
+            last_rt = row_keys(chunk_rt[-1:])[0]
+        if len(chunk_hist):
+            last_hist = row_keys(chunk_hist[-1:])[0]
+
+        _, pos_rt, pos_hist = np.intersect1d(
+            row_keys(pending_rt),
+            row_keys(pending_hist),
+            assume_unique=True,
+            return_indices=True,
+        )
+
+        diff = pending_rt[pos_rt][:, idx_rt] - pending_hist[pos_hist][:, idx_hist]
+        valid = np.isfinite(diff)
+
+        count += valid.sum(axis=0)
+        # fmax has no identity, so it cannot reduce chunks without common rows
+        if len(diff):
+            max_err = np.fmax(max_err, np.fmax.reduce(np.abs(diff), axis=0))
+
+        diff = np.where(valid, diff, 0.0)
+        total += diff.sum(axis=0)
+        total_sq += (diff * diff).sum(axis=0)
+
+        pending_rt = np.delete(pending_rt, pos_rt, axis=0)
+        pending_hist = np.delete(pending_hist, pos_hist, axis=0)
+
+        # Rows before the last one read from the other file have no pair
+        if behind(pending_rt, last_hist) or behind(pending_hist, last_rt):
+            raise ValueError("Different lat/lon rows", fname_rt, fname_hist)
+
+    if len(pending_rt) or len(pending_hist):
+        raise ValueError("Different lat/lon rows", fname_rt, fname_hist)
+
+    index = pd.MultiIndex.from_tuples(
+        [(var, time) for time, var in common], names=["var", "time"]
+    )
+    return pd.DataFrame(
+        {"n": count, "sum": total, "sum_sq": total_sq, "max": max_err}, index=index
+    )
+
+
+def summarize(partials):
+    """Combine the accumulators of several files into bias, RMSE and max error"""
+    acc = pd.concat(partials).groupby(level=["var", "time"]).agg(
+        {"n": "sum", "sum": "sum", "sum_sq": "sum", "max": "max"}
+    )
+    return pd.DataFrame(
+        {
+            "n": acc["n"],
+            "bias": acc["sum"] / acc["n"],
+            "rmse": np.sqrt(acc["sum_sq"] / acc["n"]),
+            "max": acc["max"],
+        }
+    )
+
+
+def file_pairs(path_rt, path_hist):
+    """Pair the files with the same name if both paths are directories,
+    skipping the markers, fragments and temporary files of the downloads"""
+    if os.path.isdir(path_rt) and os.path.isdir(path_hist):
+        names = sorted(set(os.listdir(path_rt)) & set(os.listdir(path_hist)))
+        return [
+            (os.path.join(path_rt, name), os.path.join(path_hist, name))
+            for name in names
+            if not is_artifact(name) and os.path.isfile(os.path.join(path_rt, name))
+        ]
+    return [(path_rt, path_hist)]
+
+
+def main(args):
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        epilog="Report bugs or suggestions to <alberto.torres@icmat.es>",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="number of file pairs compared in parallel [Default: %(default)s]",
+        type=int,
+        default=os.cpu_count(),
+    )
+    parser.add_argument(
+        "-c",
+        "--chunksize",
+        help="number of rows read at once [Default: %(default)s]",
+        type=int,
+        default=100000,
+    )
+    parser.add_argument(
+        "-m",
+        "--map",
+        help="JSON file mapping historical to real time variables",
+        default=None,
+    )
+    parser.add_argument(
+        "-o", "--output", help="write the summary to a CSV file", default=None
+    )
+    parser.add_argument("gfs", metavar="GFS", help="real time file or directory")
+    parser.add_argument(
+        "gfs_hist", metavar="GFS_HIST", help="historical file or directory"
+    )
+    args = parser.parse_args()
+
+    if args.map:
+        with open(args.map, "r") as f:
+            mapping = json.load(f)
+    else:
+        mapping = MAP
+
+    pairs = file_pairs(args.gfs, args.gfs_hist)
+    if not pairs:
+        sys.exit("No files to compare")
+
+    compare = partial(compare_pair, mapping=mapping, chunksize=args.chunksize)
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        partials = list(executor.map(compare, *zip(*pairs)))
 
-if __name__ == '__main__':
+    summary = summarize(partials)
 
-    if len(sys.argv) != 3:
-        print "usage: {} GFS GFS_HIST".format(sys.argv[0])
-        sys.exit(1)
+    if args.output:
+        summary.to_csv(args.output, float_format="%.6g")
+    else:
+        print(summary.to_string())
+    return 0
 
-    df1 = pd.read_csv(sys.argv[1], sep=" ", header=[0, 1], index_col=[0, 1])
-    df2 = pd.read_csv(sys.argv[2], sep=" ", header=[0, 1], index_col=[0, 1])
-    df2.rename(columns=MAP, level='var', inplace=True)
 
-    print df1.sub(df2).abs().sum(axis=1)
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Parsing time of the text outputs by gfsget convert
+
+Writes a synthetic output with the layout of the pydap scripts (two level
+time/var header, lat/lon rows, 3 decimals and NaN as empty fields) and
+reports the best time of reading it with pd.read_csv(header=[0, 1],
+index_col=[0, 1]), with read_legacy and the whole conversion (read_legacy and
+to_long). Fails if read_legacy does not give the same values, bit by bit, or
+if it is not faster than pd.read_csv.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from gfsget.convert import read_legacy, to_long
+
+VARS = ("tmp2m0", "ugrd10m0", "vgrd10m0")
+
+
+def write_output(fname, res, ntime):
+    lat = np.arange(-90, 90 + res / 2, res)
+    lon = np.arange(-180, 180, res)
+    index = pd.MultiIndex.from_product((lat, lon), names=["lat", "lon"])
+    columns = pd.MultiIndex.from_product(
+        (range(0, 3 * ntime, 3), VARS), names=["time", "var"]
+    )
+    rng = np.random.default_rng(0)
+    values = rng.normal(280, 20, (len(index), len(columns)))
+    values[::97, ::5] = np.nan
+    data = pd.DataFrame(values, index=index, columns=columns)
+    data.to_csv(fname, sep=" ", float_format="%.3f")
+    return data.shape
+
+
+def best_time(func, repeat):
+    """Best wall time in seconds of func() and its last result"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(args):
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="Report bugs or suggestions to <alberto.torres@icmat.es>",
+    )
+    parser.add_argument(
+        "-r",
+        "--res",
+        help="resolution of the global grid in degrees [Default: %(default)s]",
+        type=float,
+        default=0.5,
+    )
+    parser.add_argument(
+        "-t",
+        "--times",
+        help="number of time steps [Default: %(default)s]",
+        type=int,
+        default=22,
+    )
+    parser.add_argument(
+        "-n",
+        "--repeat",
+        help="number of runs of each measure [Default: %(default)s]",
+        type=int,
+        default=5,
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, "20210217_00")
+        nrows, ncols = write_output(fname, args.res, args.times)
+        print(f"{nrows} rows x {ncols + 2} columns, {os.path.getsize(fname)} bytes")
+
+        baseline, data = best_time(
+            lambda: pd.read_csv(fname, sep=" ", header=[0, 1], index_col=[0, 1]),
+            args.repeat,
+        )
+        legacy, (columns, lat, lon, values) = best_time(
+            lambda: read_legacy(fname), args.repeat
+        )
+        convert, _ = best_time(lambda: to_long(*read_legacy(fname)), args.repeat)
+
+    print(f"{'pd.read_csv':<25}{baseline:>8.2f} s")
+    print(f"{'read_legacy':<25}{legacy:>8.2f} s{baseline / legacy:>8.1f}x")
+    print(f"{'read_legacy + to_long':<25}{convert:>8.2f} s{baseline / convert:>8.1f}x")
+
+    failed = False
+    expected = data.to_numpy(dtype=np.float64)
+    index = data.index.to_frame().to_numpy(dtype=np.float64)
+    same = (
+        np.array_equal(expected.view(np.uint64), values.view(np.uint64))
+        and np.array_equal(index[:, 0], lat)
+        and np.array_equal(index[:, 1], lon)
+        and columns == [(int(time), var) for time, var in data.columns]
+    )
+    if not same:
+        print("read_legacy does not give the values of pd.read_csv")
+        failed = True
+    if legacy >= baseline:
+        print("read_legacy is not faster than pd.read_csv")
+        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Stand-in OPeNDAP (DAP2) server for local NetCDF files
+
+Serves the NetCDF files under a directory with the same paths as the GFS
+servers, so the download commands and the extraction service can be run
+without network access, for instance with the files of a previous download:
+
+    ./dap_server.py -p 8080 data/
+    gfsget serve --base-url http://localhost:8080/dods
+
+where data/dods/gfs_0p25_1hr/gfs20210217/gfs_0p25_1hr_00z.nc is served as
+http://localhost:8080/dods/gfs_0p25_1hr/gfs20210217/gfs_0p25_1hr_00z.
+
+Only what the netCDF library needs is implemented: the .dds, .das and .dods
+responses of arrays, with hyperslab constraints.
+"""
+import argparse
+import logging
+import os
+import re
+import struct
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+import netCDF4
+import numpy as np
+
+# NetCDF type: DAP type and XDR encoding (16 bit integers are sent as 32 bit).
+# The rest of the types are served as Float64
+TYPES = {
+    "f4": ("Float32", ">f4"),
+    "f8": ("Float64", ">f8"),
+    "i4": ("Int32", ">i4"),
+    "u4": ("UInt32", ">u4"),
+    "i2": ("Int16", ">i4"),
+    "u2": ("UInt16", ">u4"),
+}
+
+HYPERSLAB = re.compile(r"\[(\d+)(?::(\d+))?(?::(\d+))?\]")
+
+# The netCDF library is not thread safe
+LOCK = threading.Lock()
+
+
+def dap_type(dtype):
+    return TYPES.get(np.dtype(dtype).str[1:], ("Float64", ">f8"))
+
+
+def parse_constraint(query, nc):
+    """(name, slices) of each projected variable, all of them by default"""
+    if not query:
+        return [
+            (name, tuple(slice(None) for _ in var.dimensions))
+            for name, var in nc.variables.items()
+        ]
+
+    projections = []
+    for item in unquote(query).split("&")[0].split(","):
+        # Grid members are requested as grid.member
+        name = item.split("[", 1)[0].split(".")[-1]
+        if name not in nc.variables:
+            raise KeyError(name)
+        slices = []
+        for first, second, third in HYPERSLAB.findall(item):
+            start = int(first)
+            if third:
+                stride, stop = int(second), int(third)
+            else:
+                stride, stop = 1, int(second or first)
+            slices.append(slice(start, stop + 1, stride))
+        ndim = len(nc.variables[name].dimensions)
+        projections.append((name, tuple(slices + [slice(None)] * (ndim - len(slices)))))
+    return projections
+
+
+def declaration(name, var, slices):
+    shape = [len(range(*index.indices(size))) for index, size in zip(slices, var.shape)]
+    dims = "".join(f"[{dim} = {size}]" for dim, size in zip(var.dimensions, shape))
+    return f"    {dap_type(var.dtype)[0]} {name}{dims};"
+
+
+def dds(nc, projections, dataset):
+    lines = ["Dataset {"]
+    lines += [declaration(name, nc[name], slices) for name, slices in projections]
+    lines.append(f"}} {dataset};")
+    return "\n".join(lines) + "\n"
+
+
+def attribute(name, value):
+    if isinstance(value, str):
+        escaped = value.replace("\\", "\\\\").replace('"', '\\"')
+        return f'String {name} "{escaped}";'
+    values = np.atleast_1d(value)
+    kind = dap_type(values.dtype)[0]
+    fmt = "%.9g" if kind == "Float32" else "%.17g" if kind == "Float64" else "%d"
+    return f"{kind} {name} {', '.join(fmt % item for item in values)};"
+
+
+def das(nc):
+    lines = ["Attributes {"]
+    groups = [(name, var, var.ncattrs()) for name, var in nc.variables.items()]
+    groups.append(("NC_GLOBAL", nc, nc.ncattrs()))
+    for name, obj, attrs in groups:
+        lines.append(f"    {name} {{")
+        lines += [
+            f"        {attribute(attr, obj.getncattr(attr))}"
+            for attr in attrs
+            if attr != "_NCProperties"
+        ]
+        lines.append("    }")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def dods(nc, projections, dataset):
+    chunks = [dds(nc, projections, dataset).encode(), b"\nData:\n"]
+    for name, slices in projections:
+        var = nc[name]
+        values = np.asarray(var[slices] if var.ndim else var[...])
+        data = values.astype(dap_type(var.dtype)[1]).tobytes()
+        if var.ndim:
+            chunks.append(struct.pack(">ii", values.size, values.size))
+        chunks.append(data)
+    return b"".join(chunks)
+
+
+class DAPHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        base, suffix = os.path.splitext(unquote(url.path))
+        fname = os.path.join(self.server.root, base.lstrip("/"))
+        if not os.path.isfile(fname):
+            fname += ".nc"
+
+        if suffix not in (".dds", ".das", ".dods") or not os.path.isfile(fname):
+            return self.error(404, f"{url.path} not found")
+
+        dataset = os.path.basename(base)
+        try:
+            with LOCK, netCDF4.Dataset(fname) as nc:
+                nc.set_auto_maskandscale(False)
+                if suffix == ".das":
+                    body = das(nc).encode()
+                else:
+                    projections = parse_constraint(url.query, nc)
+                    if suffix == ".dds":
+                        body = dds(nc, projections, dataset).encode()
+                    else:
+                        body = dods(nc, projections, dataset)
+        except (KeyError, IndexError, ValueError) as err:
+            return self.error(400, f"Bad constraint: {err}")
+
+        content_type = "application/octet-stream" if suffix == ".dods" else "text/plain"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Description", f"dods_{suffix[1:]}")
+        self.send_header("XDODS-Server", "dods/2.0")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def error(self, code, message):
+        body = f'Error {{\n    code = {code};\n    message = "{message}";\n}};\n'
+        self.send_response(code)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Description", "dods_error")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, format, *args):
+        logging.info(f"{self.address_string()} {format % args}")
+
+
+def main(args):
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="Report bugs or suggestions to <alberto.torres@icmat.es>",
+    )
+    parser.add_argument(
+        "-H",
+        "--host",
+        help="address to listen on [Default: %(default)s]",
+        default="127.0.0.1",
+    )
+    parser.add_argument(
+        "-p",
+        "--port",
+        help="port to listen on [Default: %(default)s]",
+        type=int,
+        default=8080,
+    )
+    parser.add_argument("root", metavar="ROOT", help="directory with the files")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    server = ThreadingHTTPServer((args.host, args.port), DAPHandler)
+    server.root = args.root
+    logging.info(f"Serving {args.root} on http://{args.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
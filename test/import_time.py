@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Import time of the gfsget modules and startup time of the command line
+
+Every module is imported in a fresh interpreter with ``python -X importtime``
+and the best of several runs is reported, together with its slowest direct
+imports. Fails if a module imports one of the packages it should not need, or
+if it takes longer than its budget, so that the download commands run from
+cron keep starting fast.
+"""
+import argparse
+import subprocess
+import sys
+import time
+
+PLOTTING = ("cartopy", "matplotlib", "PIL")
+
+#          Module          Packages that it must not import      Budget (ms)
+TARGETS = [("gfsget.cli",      ("typer", "numpy", "xarray") + PLOTTING, 50),
+           ("gfsget.realtime", PLOTTING,                                1500),
+           ("gfsget.hist",     PLOTTING,                                1500),
+           ("gfsget.convert",  PLOTTING + ("xarray",),                  1500),
+           ("gfsget.query",    PLOTTING + ("xarray",),                  1500),
+           ("gfsget.serve",    PLOTTING,                                1500),
+           ("gfsget.plot",     (),                                      None)]
+
+# Command lines whose startup time is reported
+COMMANDS = [["--help"],
+            ["realtime", "--help"],
+            ["hist", "--help"],
+            ["plot", "--help"]]
+
+
+def import_time(module):
+    """Cumulative import time of a module in microseconds, its direct imports
+    as (name, time) and the set of modules loaded in the interpreter"""
+    code = f"import sys, {module}; print(' '.join(sys.modules))"
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    total, children, direct = None, [], []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 1:
+            children.append((name.strip(), int(cumulative)))
+        elif depth == 0:
+            if name.strip() == module:
+                total, direct = int(cumulative), children
+            children = []
+
+    return total, direct, set(proc.stdout.split())
+
+
+def startup_time(command, repeat):
+    """Best wall time in seconds of running a command"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            command,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(args):
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="Report bugs or suggestions to <alberto.torres@icmat.es>",
+    )
+    parser.add_argument(
+        "-n",
+        "--repeat",
+        help="number of runs of each measure [Default: %(default)s]",
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "-s",
+        "--scale",
+        help="multiply the budgets by this factor, for slow machines "
+        "[Default: %(default)s]",
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="show the slowest direct imports of each module",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'module':<18}{'import (ms)':>12}{'budget (ms)':>13}")
+    for module, forbidden, budget in TARGETS:
+        runs = [import_time(module) for _ in range(args.repeat)]
+        total, direct, loaded = min(runs, key=lambda run: run[0])
+
+        status = ""
+        if budget is not None and total / 1000 > budget * args.scale:
+            status = "  over budget"
+        unwanted = sorted(name for name in forbidden if name in loaded)
+        if unwanted:
+            status += f"  imports {', '.join(unwanted)}"
+        failed = failed or bool(status)
+
+        budget_str = "-" if budget is None else f"{budget * args.scale:.0f}"
+        print(f"{module:<18}{total / 1000:>12.1f}{budget_str:>13}{status}")
+        if args.verbose:
+            for name, cumulative in sorted(direct, key=lambda x: -x[1])[:5]:
+                print(f"    {name:<30}{cumulative / 1000:>8.1f}")
+
+    print(f"\n{'command':<25}{'startup (ms)':>13}")
+    elapsed = startup_time([sys.executable, "-c", "pass"], args.repeat)
+    print(f"{'python -c pass':<25}{elapsed * 1000:>13.1f}")
+    for command in COMMANDS:
+        command = ["gfsget"] + command
+        elapsed = startup_time([sys.executable, "-m"] + command, args.repeat)
+        print(f"{' '.join(command):<25}{elapsed * 1000:>13.1f}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Tests of the streaming temporal interpolation (gfsget.interp)
+
+Can be run directly or with pytest. Checks the interpolated times, including
+steps that do not divide the input spacing, the values of both methods at
+the first and last segments, where cubic has no neighbour on one side, and
+that the input steps are consumed as a stream.
+"""
+import sys
+
+import numpy as np
+import pandas as pd
+
+from gfsget.interp import interpolate_steps
+
+
+def knots(func, times):
+    return [(time, np.array([func(time)], dtype=np.float64)) for time in times]
+
+
+def run(func, times, step, method):
+    result = list(interpolate_steps(knots(func, times), step, method))
+    return [time for time, _ in result], np.array([field[0] for _, field in result])
+
+
+def test_times():
+    for method in ("linear", "cubic"):
+        assert run(float, range(0, 10, 3), 1, method)[0] == list(range(10))
+        # Targets that do not divide the 3h spacing, and a last input step
+        # that is not a target
+        assert run(float, range(0, 13, 3), 2, method)[0] == list(range(0, 13, 2))
+        assert run(float, range(0, 10, 3), 4, method)[0] == [0, 4, 8]
+        assert run(float, [6], 1, method)[0] == [6]
+        assert run(float, [], 1, method)[0] == []
+
+
+def test_linear():
+    def func(t):
+        return 2.0 * t - 5.0
+
+    times, values = run(func, range(0, 10, 3), 1, "linear")
+    np.testing.assert_allclose(values, [func(t) for t in times])
+
+    def square(t):
+        return float(t * t)
+
+    times, values = run(square, [0, 3], 2, "linear")
+    np.testing.assert_allclose(values, [0.0, 6.0])
+
+
+def test_cubic():
+    def line(t):
+        return 0.5 * t + 1.0
+
+    # One sided tangents at both ends are exact for linear fields, also with
+    # only two input steps
+    for inputs in (range(0, 13, 3), [0, 3]):
+        times, values = run(line, inputs, 1, "cubic")
+        np.testing.assert_allclose(values, [line(t) for t in times])
+
+    def square(t):
+        return float(t * t)
+
+    # Centered differences are exact for quadratics inside, while the outer
+    # tangents of the first and last segments are the difference of the two
+    # steps of the segment
+    times, values = run(square, range(0, 13, 3), 1, "cubic")
+    values = dict(zip(times, values))
+    for t in range(3, 10):
+        np.testing.assert_allclose(values[t], square(t))
+    for t in (0, 12):
+        np.testing.assert_allclose(values[t], square(t))
+    # x = 1/3 on [0, 3], f1 = 0, f2 = 9, m1 = 9, m2 = (36 - 0) / 2 = 18
+    np.testing.assert_allclose(values[1], 9 * 7 / 27 + 9 * 4 / 27 - 18 * 2 / 27)
+    # x = 2/3 on [9, 12], f1 = 81, f2 = 144, m1 = (144 - 36) / 2, m2 = 63
+    x = 2 / 3
+    expected = (
+        81 * (2 * x**3 - 3 * x**2 + 1)
+        + 54 * (x**3 - 2 * x**2 + x)
+        + 144 * (-2 * x**3 + 3 * x**2)
+        + 63 * (x**3 - x**2)
+    )
+    np.testing.assert_allclose(values[11], expected)
+
+
+def test_dataframes():
+    columns = ["ugrd10m0", "vgrd10m0"]
+    steps = [
+        (time, pd.DataFrame([[time, -time]], columns=columns, dtype=np.float32))
+        for time in range(0, 7, 3)
+    ]
+    result = list(interpolate_steps(steps, 1, "cubic"))
+    assert all(list(field.columns) == columns for _, field in result)
+    np.testing.assert_allclose(
+        [field.values[0] for _, field in result], [[t, -t] for t in range(7)]
+    )
+
+
+def test_streaming():
+    # Input steps after the interpolated time needed by each method
+    needed = {"linear": 1, "cubic": 2}
+    for method, size in needed.items():
+        pulled = []
+
+        def steps():
+            for time in range(0, 31, 3):
+                pulled.append(time)
+                yield time, np.array([float(time)])
+
+        for time, _ in interpolate_steps(steps(), 1, method):
+            # Only the steps around the interpolated time have been requested
+            ahead = [t for t in pulled if t > time]
+            assert len(ahead) <= size, (method, time, pulled)
+
+
+def main(args):
+    failed = 0
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_") and callable(test):
+            try:
+                test()
+            except AssertionError as err:
+                failed += 1
+                print(f"{name}: FAILED {err}")
+            else:
+                print(f"{name}: ok")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
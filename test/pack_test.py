@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Tests of the lossy packing of the variables (gfsget.pack)
+
+Can be run directly or with pytest. Checks the bits kept by bitround and its
+rounding, the error bound and the clipping (with a warning) of quantize, and
+that a packed text output is read back by gfsget convert with the packed
+values and no more decimals than the ones of each rule.
+"""
+import logging
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from gfsget.convert import read_legacy
+from gfsget.pack import INT16_MAX, bitround, decimals, quantize, to_csv_packed
+
+
+class Warnings(logging.Handler):
+    """Messages of the warnings logged inside the with block"""
+
+    def __enter__(self):
+        self.messages = []
+        logging.getLogger().addHandler(self)
+        return self.messages
+
+    def __exit__(self, *exc):
+        logging.getLogger().removeHandler(self)
+
+    def emit(self, record):
+        if record.levelno >= logging.WARNING:
+            self.messages.append(record.getMessage())
+
+
+def test_bitround():
+    rng = np.random.default_rng(0)
+    values = (rng.normal(0, 1, 10000) * 10.0 ** rng.integers(-5, 6, 10000)).astype(
+        np.float32
+    )
+    for bits in (1, 7, 12, 22, 23):
+        rounded = bitround(values, bits)
+        assert rounded.dtype == np.float32
+        # The dropped bits of the mantissa are zero
+        mask = np.uint32((1 << (23 - bits)) - 1)
+        assert not np.any(rounded.view(np.uint32) & mask), bits
+        error = np.abs(rounded.astype(np.float64) - values) / np.abs(values)
+        assert error.max() <= 2.0 ** -(bits + 1), (bits, error.max())
+
+    # Halfway values are rounded to the even mantissa: 1.001b and 1.011b
+    np.testing.assert_array_equal(bitround([1.125, 1.375, -1.125], 2), [1, 1.5, -1])
+    special = np.array([np.nan, np.inf, -np.inf, 0.0], dtype=np.float32)
+    np.testing.assert_array_equal(bitround(special, 5), special)
+
+
+def test_quantize():
+    rule = {"scale": 0.01, "offset": 273.15}
+    rng = np.random.default_rng(0)
+    values = rng.normal(280, 20, 10000)
+    values[::100] = np.nan
+    with Warnings() as messages:
+        packed = quantize(values, rule, "tmp2m")
+    assert not messages
+    assert np.array_equal(np.isnan(packed), np.isnan(values))
+    assert np.nanmax(np.abs(packed - values)) <= rule["scale"] / 2 + 1e-9
+    steps = (packed - rule["offset"]) / rule["scale"]
+    np.testing.assert_allclose(steps, np.round(steps), atol=1e-6)
+
+    # Out of offset +- 32767 * scale
+    top = rule["offset"] + INT16_MAX * rule["scale"]
+    bottom = rule["offset"] - INT16_MAX * rule["scale"]
+    with Warnings() as messages:
+        packed = quantize([top + 1, bottom - 1, 280.0], rule, "tmp2m")
+    np.testing.assert_allclose(packed, [top, bottom, 280.0])
+    assert len(messages) == 1 and messages[0].startswith("tmp2m: 2 values"), messages
+
+
+def test_text_round_trip():
+    rules = {
+        "ugrd10m": {"scale": 0.01},
+        "tmp2m": {"scale": 0.05, "offset": 273.15},
+        "hgtprs": {"bits": 12},
+    }
+    names = ["ugrd10m0", "tmp2m0", "pressfc0", "hgtprs0"]
+    index = pd.MultiIndex.from_product(
+        (np.arange(35.0, 45.0, 0.5), np.arange(-10.0, 5.0, 0.5)), names=["lat", "lon"]
+    )
+    columns = pd.MultiIndex.from_product(
+        (range(0, 12, 3), names), names=["time", "var"]
+    )
+    rng = np.random.default_rng(0)
+    means = np.tile([0.0, 280.0, 101325.0, 200.0], 4)
+    values = rng.normal(means, 0.05 * np.abs(means) + 5, (len(index), len(columns)))
+    values[::7, ::3] = np.nan
+    data = pd.DataFrame(values, index=index, columns=columns)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, "20210217_00.gz")
+        # Two blocks of rows, appended as gzip members
+        half = len(data) // 2
+        with open(fname, "wb") as f:
+            to_csv_packed(data.iloc[:half], f, rules)
+            to_csv_packed(data.iloc[half:], f, rules, header=False)
+        read_columns, lat, lon, read = read_legacy(fname)
+        with open(fname, "rb") as f:
+            text = pd.read_csv(
+                f, compression="gzip", sep=" ", header=None, skiprows=3, dtype=str
+            )
+
+    assert read_columns == list(data.columns)
+    np.testing.assert_array_equal(lat, index.get_level_values("lat"))
+    np.testing.assert_array_equal(lon, index.get_level_values("lon"))
+
+    for idx, (_, name) in enumerate(data.columns):
+        rule = rules.get(name.rstrip("0123456789"))
+        expected = values[:, idx] if rule is None else quantize(values[:, idx], rule)
+        expected = np.round(np.asarray(expected, np.float64), decimals(rule))
+        np.testing.assert_array_equal(read[:, idx], expected)
+        # No more digits than the decimals of the rule
+        fields = text[idx + 2].dropna()
+        digits = fields.str.partition(".")[2].str.len()
+        assert digits.max() <= decimals(rule), (name, fields[digits.idxmax()])
+
+
+def main(args):
+    failed = 0
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_") and callable(test):
+            try:
+                test()
+            except AssertionError as err:
+                failed += 1
+                print(f"{name}: FAILED {err}")
+            else:
+                print(f"{name}: ok")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
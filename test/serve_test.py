@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+""" Request coalescing of the extraction service
+
+Writes a small real time forecast to a temporary directory, serves it with
+dap_server.py, starts ``gfsget serve`` on top of it and sends several
+identical /realtime requests at the same time. Fails unless all of them get
+the same response and /stats reports a single miss, that is, the region was
+extracted only once.
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+DATE = "20210217"
+
+QUERY = "/realtime?date={0}&run=0&vars=ugrd10m,vgrd10m&lat=30,45&lon=-10,5&hours=1,2"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def write_forecast(root):
+    """1º global forecast with the path of the real time server"""
+    path = os.path.join(root, "dods", "gfs_0p25_1hr", f"gfs{DATE}")
+    os.makedirs(path)
+    times = pd.date_range(DATE, periods=4, freq="h")
+    lat = np.arange(-90.0, 91.0)
+    lon = np.arange(0.0, 360.0)
+    rng = np.random.default_rng(0)
+    shape = (len(times), len(lat), len(lon))
+    dataset = xr.Dataset(
+        {
+            name: (("time", "lat", "lon"), rng.normal(0, 10, shape).astype("f4"))
+            for name in ("ugrd10m", "vgrd10m")
+        },
+        coords={"time": times, "lat": lat, "lon": lon},
+    )
+    dataset.to_netcdf(os.path.join(path, "gfs_0p25_1hr_00z.nc"))
+
+
+def wait_for(url, timeout):
+    """Wait until the server of url answers, even if with an error"""
+    start = time.monotonic()
+    while True:
+        try:
+            return urllib.request.urlopen(url).read()
+        except urllib.error.HTTPError:
+            return None
+        except OSError:
+            if time.monotonic() - start > timeout:
+                raise
+            time.sleep(0.2)
+
+
+def main(args):
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="Report bugs or suggestions to <alberto.torres@icmat.es>",
+    )
+    parser.add_argument(
+        "-n",
+        "--requests",
+        help="number of identical requests sent at once [Default: %(default)s]",
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        help="seconds to wait for the servers [Default: %(default)s]",
+        type=float,
+        default=60.0,
+    )
+    args = parser.parse_args()
+
+    test_dir = os.path.dirname(os.path.abspath(__file__))
+    dap_port, serve_port = free_port(), free_port()
+    base = f"http://127.0.0.1:{serve_port}"
+
+    with tempfile.TemporaryDirectory() as root:
+        write_forecast(root)
+        procs = [
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    os.path.join(test_dir, "dap_server.py"),
+                    "-p",
+                    str(dap_port),
+                    root,
+                ],
+                stderr=subprocess.DEVNULL,
+            ),
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "gfsget",
+                    "serve",
+                    "--port",
+                    str(serve_port),
+                    "--base-url",
+                    f"http://127.0.0.1:{dap_port}/dods",
+                    "--log",
+                    "warning",
+                ],
+            ),
+        ]
+        try:
+            wait_for(f"http://127.0.0.1:{dap_port}/", args.timeout)
+            wait_for(base + "/stats", args.timeout)
+
+            bodies = [None] * args.requests
+            barrier = threading.Barrier(args.requests)
+
+            def request(idx):
+                barrier.wait()
+                bodies[idx] = urllib.request.urlopen(base + QUERY.format(DATE)).read()
+
+            threads = [
+                threading.Thread(target=request, args=(idx,))
+                for idx in range(args.requests)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            stats = json.loads(urllib.request.urlopen(base + "/stats").read())
+        finally:
+            for proc in procs:
+                proc.terminate()
+                proc.wait()
+
+    print(json.dumps(stats, sort_keys=True))
+    failed = False
+    if None in bodies or len(set(bodies)) != 1:
+        print("The responses of the identical requests differ")
+        failed = True
+    if stats.get("requests") != args.requests or stats.get("misses") != 1:
+        print(f"Expected {args.requests} requests and 1 miss")
+        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))